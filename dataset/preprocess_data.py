@@ -11,7 +11,7 @@ import h5py
 import logging
 import numpy as np
 from functools import reduce
-from utils.functions import pad_sequences
+from utils.functions import pad_sequences, convert_embedding_storage, window_starts
 
 logger = logging.getLogger(__name__)
 
@@ -35,10 +35,14 @@ class PreprocessData:
         self.__glove_path = ''
         self.__embedding_size = 300
         self.__ignore_max_len = 10000
+        self.__window_size = 0
+        self.__window_stride = 0
+        self.__embedding_storage = 'float32'
         self.__load_config(global_config)
 
         # preprocess config
-        self.__max_context_token_len = 0
+        self.__max_train_context_len = 0  # no more than window_size when windowed
+        self.__max_dev_context_len = 0
         self.__max_question_token_len = 0
         self.__max_answer_len = 0
 
@@ -67,6 +71,11 @@ class PreprocessData:
         self.__export_squad_path = data_config['dataset_h5']
         self.__glove_path = data_config['embedding_path']
         self.__ignore_max_len = data_config['ignore_max_len']
+        self.__window_size = data_config['window_size']
+        self.__window_stride = data_config['window_stride']
+        if self.__window_size > 0 and not 0 < self.__window_stride <= self.__window_size:
+            raise ValueError('window_stride should be in (0, window_size], but got %d' % self.__window_stride)
+        self.__embedding_storage = data_config['embedding_storage']
         self.__embedding_size = int(global_config['model']['word_embedding_size'])
 
     def __read_json(self, path):
@@ -85,10 +94,13 @@ class PreprocessData:
         self.__attr['dataset_name'] = 'squad-' + version
         return contexts_qas
 
-    def __build_data(self, contexts_qas):
+    def __build_data(self, contexts_qas, training=False):
         """
-        handle squad data to (context, question, answer_range) with word id representation
+        handle squad data to (context, question, answer_range) with word id representation.
+        when window_size enabled, long contexts are not dropped: the train ones are split into overlapping windows
+        with answers in each window, and the dev ones are kept whole that the model predicts on windows
         :param contexts_qas: a context with several question-answers
+        :param training: whether train set
         :return:
         """
         contexts_wid = []
@@ -101,12 +113,17 @@ class PreprocessData:
             cur_qas = question_grp['qas']
 
             cur_context_toke = nltk.word_tokenize(cur_context)
-            if len(cur_context_toke) > self.__ignore_max_len:  # some context token len too large, such as 766
-                continue
+            if self.__window_size <= 0 and len(cur_context_toke) > self.__ignore_max_len:
+                continue    # some context token len too large, such as 766
 
             self.__update_to_char(cur_context)
             cur_context_ids = self.__sentence_to_id(cur_context_toke)
-            self.__max_context_token_len = max(self.__max_context_token_len, len(cur_context_ids))
+            windowed = training and 0 < self.__window_size < len(cur_context_ids)
+            cur_context_len = self.__window_size if windowed else len(cur_context_ids)
+            if training:
+                self.__max_train_context_len = max(self.__max_train_context_len, cur_context_len)
+            else:
+                self.__max_dev_context_len = max(self.__max_dev_context_len, cur_context_len)
 
             for qa in cur_qas:
                 cur_question = qa['question']
@@ -115,10 +132,6 @@ class PreprocessData:
                 cur_question_ids = self.__sentence_to_id(cur_question_toke)
                 self.__max_question_token_len = max(self.__max_question_token_len, len(cur_question_ids))
 
-                contexts_wid.append(cur_context_ids)
-                questions_wid.append(cur_question_ids)
-                samples_id.append(qa['id'])
-
                 # find all the answer positions
                 cur_answers = qa['answers']
                 self.__max_answer_len = max(self.__max_answer_len, len(cur_answers) * 2)
@@ -165,7 +178,27 @@ class PreprocessData:
 
                     cur_ans_range_ids[(idx * 2):(idx * 2 + 2)] = [pos_s, pos_e]
 
-                answers_range_wid.append(cur_ans_range_ids)
+                if not windowed:
+                    contexts_wid.append(cur_context_ids)
+                    questions_wid.append(cur_question_ids)
+                    answers_range_wid.append(cur_ans_range_ids)
+                    samples_id.append(qa['id'])
+                    continue
+
+                # windows without whole answer are dropped
+                for start in window_starts(len(cur_context_ids), self.__window_size, self.__window_stride):
+                    end = start + self.__window_size
+                    window_ans_range_ids = []
+                    for pos_s, pos_e in zip(cur_ans_range_ids[0::2], cur_ans_range_ids[1::2]):
+                        if start <= pos_s and pos_e < end:
+                            window_ans_range_ids += [pos_s - start, pos_e - start]
+                    if len(window_ans_range_ids) == 0:
+                        continue
+
+                    contexts_wid.append(cur_context_ids[start:end])
+                    questions_wid.append(cur_question_ids)
+                    answers_range_wid.append(window_ans_range_ids)
+                    samples_id.append(qa['id'])
 
         return {'context': contexts_wid,
                 'question': questions_wid,
@@ -244,6 +277,7 @@ class PreprocessData:
         id2word = np.array(self.__meta_data['id2word'], dtype=np.str)
         id2char = np.array(self.__meta_data['id2char'], dtype=np.str)
         id2vec = np.array(self.__meta_data['id2vec'], dtype=np.float32)
+        id2vec, id2vec_scale = convert_embedding_storage(id2vec, None, self.__embedding_storage)
         f_meta_data = f.create_group('meta_data')
 
         meta_data = f_meta_data.create_dataset('id2word', id2word.shape, dtype=str_dt, **self.__compress_option)
@@ -255,6 +289,11 @@ class PreprocessData:
         meta_data = f_meta_data.create_dataset('id2vec', id2vec.shape, dtype=id2vec.dtype, **self.__compress_option)
         meta_data[...] = id2vec
 
+        if id2vec_scale is not None:
+            meta_data = f_meta_data.create_dataset('id2vec_scale', id2vec_scale.shape, dtype=id2vec_scale.dtype,
+                                                   **self.__compress_option)
+            meta_data[...] = id2vec_scale
+
         # data
         f_data = f.create_group('data')
         for key, value in self.__data.items():
@@ -282,7 +321,7 @@ class PreprocessData:
         dev_context_qas = self.__read_json(self.__dev_path)
 
         logger.info('transform word to id...')
-        train_cache_nopad = self.__build_data(train_context_qas)
+        train_cache_nopad = self.__build_data(train_context_qas, training=True)
         dev_cache_nopad = self.__build_data(dev_context_qas)
 
         self.__attr['train_size'] = len(train_cache_nopad['answer_range'])
@@ -295,7 +334,7 @@ class PreprocessData:
         logger.info('padding id vectors...')
         self.__data['train'] = {
             'context': pad_sequences(train_cache_nopad['context'],
-                                     maxlen=self.__max_context_token_len,
+                                     maxlen=self.__max_train_context_len,
                                      padding='post',
                                      value=self.padding_idx),
             'question': pad_sequences(train_cache_nopad['question'],
@@ -306,7 +345,7 @@ class PreprocessData:
             'samples_id': np.array(train_cache_nopad['samples_id'])}
         self.__data['dev'] = {
             'context': pad_sequences(dev_cache_nopad['context'],
-                                     maxlen=self.__max_context_token_len,
+                                     maxlen=self.__max_dev_context_len,
                                      padding='post',
                                      value=self.padding_idx),
             'question': pad_sequences(dev_cache_nopad['question'],
@@ -86,13 +86,15 @@ class SquadDataset:
                                                  shuffle=True)
         return dataloader
 
-    def get_batch_train(self, batch_size):
+    def get_batch_train(self, batch_size, rank=0, world_size=1):
         """
         a train data batch
         :param batch_size:
+        :param rank: index of the training process, that only get its shard of batches
+        :param world_size: count of training processes
         :return:
         """
-        return self.get_batch_data(batch_size, 'train')
+        return self.get_batch_data(batch_size, 'train', rank, world_size)
 
     def get_batch_dev(self, batch_size):
         """
@@ -102,16 +104,54 @@ class SquadDataset:
         """
         return self.get_batch_data(batch_size, 'dev')
 
-    def get_batch_data(self, batch_size, type):
+    def get_batch_dev_subset(self, batch_size, subset_size, seed):
+        """
+        development data batch on a fixed random subset, for quick validation when training
+        :param batch_size:
+        :param subset_size: count of samples, the whole dev set when not less than it
+        :param seed: the same seed gives the same subset
+        :return: iterator
+        """
+        data = self.__data['dev']
+        data_size = len(data['context'])
+        if subset_size >= data_size:
+            return self.get_batch_dev(batch_size)
+
+        # keep the order of dev set, that samples with similar length in the same batch
+        indices = np.sort(np.random.RandomState(seed).choice(data_size, subset_size, replace=False))
+        return self.get_batch_data_indices(batch_size, 'dev', indices)
+
+    def get_batch_data_indices(self, batch_size, type, indices):
+        """
+        get batch data of the samples on indices
+        :param batch_size:
+        :param type:
+        :param indices: sorted samples index
+        :return: iterator
+        """
+        data = self.__data[type]
+        for i in range(0, len(indices), batch_size):
+            bat_indices = indices[i:(i + batch_size)]
+            bat = [data['context'][bat_indices], data['question'][bat_indices], data['answer_range'][bat_indices]]
+            bat_tensor = [to_long_tensor(x) for x in bat]
+            yield [del_zeros_right(x) for x in bat_tensor]
+
+    def get_batch_data(self, batch_size, type, rank=0, world_size=1):
         """
         get batch data
         :param batch_size:
+        :param rank: with world_size > 1, get every world_size-th batch from rank, and drop the last batches
+         that not enough for all the processes, so that every process has the same count of batches
+        :param world_size:
         :return: iterator
         """
         data = self.__data[type]
         data_size = len(data['context'])
-        i = 0
-        while i < data_size:
+        batch_cnt = math.ceil(data_size * 1.0 / batch_size)
+        batch_cnt -= batch_cnt % world_size
+
+        for k in range(rank, batch_cnt, world_size):
+            i = k * batch_size
             j = min(i + batch_size, data_size)
             bat = [data['context'][i:j], data['question'][i:j], data['answer_range'][i:j]]
             bat_tensor = [to_long_tensor(x) for x in bat]
@@ -123,7 +163,6 @@ class SquadDataset:
             # bat_tensor_new.append(bat_context_char)
             # bat_tensor_new.append(bat_question_char)
 
-            i = j
             yield bat_tensor_new
 
     def get_all_samples_id_train(self):
@@ -152,6 +191,9 @@ class SquadDataset:
 
         return cnt_batch
 
+    def get_dev_size(self):
+        return int(self.__attr['dev_size'])
+
     def get_dev_batch_cnt(self, batch_size):
         """
         get count of dev batches
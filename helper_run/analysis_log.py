@@ -3,62 +3,96 @@
 
 import os
 import sys
+import json
 import argparse
 import matplotlib.pyplot as plt
-import re
+from collections import OrderedDict
 
 sys.path.append(os.getcwd())
 
-TRAIN_SIZE = 87599
-DEV_SIZE = 10570
 
+def read_metrics(metrics_path):
+    """
+    read the jsonl metrics that train.py writes to `metrics_path`
+    :param metrics_path:
+    :return: list of records
+    """
+    with open(metrics_path) as f_metrics:
+        return [json.loads(line) for line in f_metrics if line.strip()]
 
-def analysis_log_loss(log_txt):
+
+def analysis_log_loss(records):
+    """
+    train loss on the end of every epoch
+    """
     epoch = []
     loss = []
-    p = re.compile(r'.*epoch=(\d*), sum_loss=(\d*\.\d*).*')
-    for line in log_txt:
-        result = re.findall(p, line)
-        if len(result) == 0:
-            continue
-
-        epoch.append(int(result[0][0]))
-        loss.append(float(result[0][1]) / TRAIN_SIZE)
+    for r in filter(lambda x: x['type'] == 'epoch', records):
+        epoch.append(r['epoch'] + 1.)
+        loss.append(r['loss'])
 
     return epoch, loss
 
 
-def analysis_log_score(log_txt):
+def analysis_log_score(records, record_type='valid'):
+    """
+    scores of validations on the whole dev set, or on dev subset with 'valid_subset'
+    :return: position in epochs, em, f1 and loss
+    """
     epoch = []
     score_em = []
     score_f1 = []
     loss = []
-    p = re.compile(r'.*epoch=(\d*), ave_score_em=(\d*\.\d*), ave_score_f1=(\d*\.\d*), sum_loss=(\d*\.\d*)$')
-    for line in log_txt:
-        result = re.findall(p, line)
-        if len(result) == 0:
-            continue
-
-        epoch.append(int(result[0][0]))
-        score_em.append(float(result[0][1]))
-        score_f1.append(float(result[0][2]))
-        loss.append(float(result[0][3]) / DEV_SIZE)
+    for r in filter(lambda x: x['type'] == record_type, records):
+        epoch.append(r['epoch'] + r['batch'] * 1. / r['batch_cnt'])
+        score_em.append(r['em'])
+        score_f1.append(r['f1'])
+        loss.append(r['loss'])
 
     return epoch, score_em, score_f1, loss
 
 
-def draw_loss(epoch, train_loss, eval_loss):
-    for i, tl, el in zip(epoch, train_loss, eval_loss):
-        print('epoch=%d, train_loss=%f, eval_loss=%f' % (i, tl, el))
+def analysis_step_time(records):
+    """
+    where the time of training steps goes, and the throughput
+    :param records:
+    :return:
+    """
+    train_records = list(filter(lambda x: x['type'] == 'train', records))
+    if len(train_records) == 0:
+        print('no train records')
+        return
+
+    phase_time = OrderedDict()
+    for r in train_records:
+        for phase, t in r['time'].items():
+            phase_time[phase] = phase_time.get(phase, 0.) + t
+    sum_time = sum(map(lambda x: x['step_time'], train_records))
+    batch_num = len(train_records)
+
+    print('%-12s %12s %10s %8s' % ('phase', 'sum(s)', 'batch(ms)', 'ratio'))
+    for phase, t in phase_time.items():
+        print('%-12s %12.2f %10.2f %7.2f%%' % (phase, t, t * 1000. / batch_num, t * 100. / sum_time))
+    print('%-12s %12.2f %10.2f' % ('total', sum_time, sum_time * 1000. / batch_num))
+
+    samples = sum(map(lambda x: x['samples'], train_records))
+    tokens = sum(map(lambda x: x['tokens'], train_records))
+    peak_memory = [x['peak_memory_mb'] for x in train_records if x['peak_memory_mb'] is not None]
+    print('batches=%d, samples/s=%.2f, tokens/s=%.2f' % (batch_num, samples / sum_time, tokens / sum_time))
+    if peak_memory:
+        print('peak_memory=%.2fMB' % max(peak_memory))
+
+
+def draw_loss(epoch, train_loss, eval_epoch, eval_loss):
+    for i, tl in zip(epoch, train_loss):
+        print('epoch=%.2f, train_loss=%f' % (i, tl))
+    for i, el in zip(eval_epoch, eval_loss):
+        print('epoch=%.2f, eval_loss=%f' % (i, el))
 
     # plot
-    x = epoch
-    y1 = train_loss
-    y2 = eval_loss
-
     plt.figure()
-    plt.plot(x, y1, marker='o', color='b')
-    plt.plot(x, y2, marker='^', color='r')
+    plt.plot(epoch, train_loss, marker='o', color='b')
+    plt.plot(eval_epoch, eval_loss, marker='^', color='r')
 
     plt.xlabel('epoch')
     plt.ylabel('loss')
@@ -68,7 +102,7 @@ def draw_loss(epoch, train_loss, eval_loss):
 
 def draw_score(epoch, score_em, score_f1):
     for i, em, f1 in zip(epoch, score_em, score_f1):
-        print('epoch=%d, score_em=%.2f, score_f1=%.2f' % (i, em, f1))
+        print('epoch=%.2f, score_em=%.2f, score_f1=%.2f' % (i, em, f1))
 
     # plot
     x = epoch
@@ -85,28 +119,35 @@ def draw_score(epoch, score_em, score_f1):
     plt.grid()
 
 
-def main(log_path, x_gen=False):
-    with open(log_path) as f_log:
-        log_lines = f_log.readlines()
-        value_log = log_lines
+def draw_throughput(records):
+    train_records = list(filter(lambda x: x['type'] == 'train', records))
+
+    plt.figure()
+    plt.plot([x['samples_per_sec'] for x in train_records], color='b')
+
+    plt.xlabel('batch')
+    plt.ylabel('samples/s')
+    plt.grid()
+
 
-    epoch, train_loss = analysis_log_loss(value_log)
-    epoch2, score_em, score_f1, eval_loss = analysis_log_score(value_log)
+def main(metrics_path):
+    records = read_metrics(metrics_path)
 
-    assert epoch == epoch2, str(epoch) + ' ' + str(epoch2)
+    epoch, train_loss = analysis_log_loss(records)
+    eval_epoch, score_em, score_f1, eval_loss = analysis_log_score(records)
 
-    if x_gen:
-        epoch = [x for x in range(len(train_loss))]
-    draw_loss(epoch, train_loss, eval_loss)
-    draw_score(epoch, score_em, score_f1)
+    analysis_step_time(records)
+    draw_loss(epoch, train_loss, eval_epoch, eval_loss)
+    draw_score(eval_epoch, score_em, score_f1)
+    draw_throughput(records)
 
     plt.show()
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="analysis log file that model output")
-    parser.add_argument('--log', '-l', required=True, nargs=1, dest='log_path')
+    parser = argparse.ArgumentParser(description="analysis metrics file that train.py output")
+    parser.add_argument('--metrics', '-m', required=False, dest='metrics_path', default='logs/train-metrics.jsonl')
     args = parser.parse_args()
 
-    print("analysising log '%s'" % args.log_path[0])
-    main(args.log_path[0], x_gen=True)
+    print("analysising metrics '%s'" % args.metrics_path)
+    main(args.metrics_path)
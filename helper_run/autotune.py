@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import time
+import yaml
+import torch
+import logging
+import argparse
+import itertools
+import multiprocessing
+from dataset.squad_dataset import SquadDataset
+from dataset.preprocess_data import PreprocessData
+from models.match_lstm import MatchLSTMModel
+from models.loss import MyNLLLoss
+from utils.load_config import init_logging, read_config
+from utils.functions import set_torch_threads, quantize_dynamic_model
+
+init_logging()
+logger = logging.getLogger(__name__)
+
+MODES = ['train', 'test']
+
+
+def default_threads():
+    """
+    powers of 2 until the count of cpu, and the count of cpu
+    :return:
+    """
+    cpu_count = os.cpu_count()
+    threads = [2 ** i for i in range(cpu_count.bit_length()) if 2 ** i < cpu_count]
+    return threads + [cpu_count]
+
+
+def run_trial(global_config, mode, num_threads, num_interop_threads, batch_size, batch_num, warmup_num, result_queue):
+    """
+    time forward and backward on train batches, or forward on dev batches when test mode, on a new process
+    that the inter-op threads could be set
+    :return: put (samples, tokens, seconds) to result_queue
+    """
+    set_torch_threads(num_threads, num_interop_threads)
+    torch.manual_seed(global_config['model']['global']['random_seed'])
+    device = torch.device('cpu')
+    enable_char = global_config['model']['encoder']['enable_char']
+
+    dataset = SquadDataset(global_config)
+    batch_data = dataset.get_batch_train(batch_size) if mode == 'train' else dataset.get_batch_dev(batch_size)
+    batch_data = list(itertools.islice(batch_data, warmup_num + batch_num))
+
+    model = MatchLSTMModel(global_config)
+    model.enable_autocast = global_config[mode]['bf16_autocast']
+    criterion = MyNLLLoss(multi_span=global_config['model']['output']['multi_span'],
+                          log_space=global_config['model']['output']['log_space'])
+    if mode == 'train':
+        model.train()
+    else:
+        model.eval()
+        if global_config['test']['quantize']:
+            model = quantize_dynamic_model(model)
+
+    samples_num = 0
+    tokens_num = 0
+    start_time = time.time()
+    for i, batch in enumerate(batch_data):
+        if i == warmup_num:
+            start_time = time.time()
+
+        bat_context, bat_question, bat_context_char, bat_question_char, bat_answer_range = \
+            dataset.gen_batch_with_char(batch, enable_char=enable_char, device=device)
+
+        with torch.set_grad_enabled(mode == 'train'):
+            ans_range_prop, _, _ = model.forward(bat_context, bat_question, bat_context_char, bat_question_char)
+            if mode == 'train':
+                model.zero_grad()
+                loss = criterion.forward(ans_range_prop, bat_answer_range)
+                loss.backward()
+
+        if i >= warmup_num:
+            samples_num += bat_context.shape[0]
+            tokens_num += sum(map(lambda x: x.ne(PreprocessData.padding_idx).sum().item(), batch[:2]))
+
+    result_queue.put((samples_num, tokens_num, time.time() - start_time))
+
+
+def trial(global_config, mode, num_threads, num_interop_threads, batch_size, batch_num, warmup_num):
+    """
+    run one trial on a spawned process
+    :return: (samples, tokens, seconds), or None when the trial failed
+    """
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    p = ctx.Process(target=run_trial, args=(global_config, mode, num_threads, num_interop_threads, batch_size,
+                                            batch_num, warmup_num, result_queue))
+    p.start()
+    p.join()
+
+    if p.exitcode != 0:
+        return None
+    return result_queue.get()
+
+
+def main(config_path, out_path, modes, threads, interop_threads, batch_sizes, batch_num, warmup_num):
+    logger.info('------------Autotune--------------')
+    logger.info('loading config file...')
+    global_config = read_config(config_path)
+
+    overlay = {}
+    for mode in modes:
+        result = []
+        for num_threads, num_interop_threads, batch_size in itertools.product(threads, interop_threads, batch_sizes):
+            logger.info('%s trial: num_threads=%d, num_interop_threads=%d, batch_size=%d'
+                        % (mode, num_threads, num_interop_threads, batch_size))
+            trial_result = trial(global_config, mode, num_threads, num_interop_threads, batch_size, batch_num,
+                                 warmup_num)
+            if trial_result is None:
+                logger.warning('trial failed')
+                continue
+
+            samples_num, tokens_num, cost_time = trial_result
+            result.append((samples_num / cost_time, tokens_num / cost_time, num_threads, num_interop_threads,
+                           batch_size))
+
+        if len(result) == 0:
+            raise ValueError('all trials of %s failed' % mode)
+
+        result.sort(reverse=True)
+        logger.info('%s result:' % mode)
+        logger.info('%8s %8s %10s %12s %12s' % ('threads', 'interop', 'batch_size', 'samples/s', 'tokens/s'))
+        for samples_speed, tokens_speed, num_threads, num_interop_threads, batch_size in result:
+            logger.info('%8d %8d %10d %12.2f %12.2f' % (num_threads, num_interop_threads, batch_size, samples_speed,
+                                                        tokens_speed))
+
+        _, _, num_threads, num_interop_threads, batch_size = result[0]
+        overlay[mode] = {'num_threads': num_threads,
+                         'num_interop_threads': num_interop_threads,
+                         'batch_size': batch_size}
+
+    with open(out_path, 'w') as f:
+        yaml.dump(overlay, f, default_flow_style=False)
+    logger.info("best settings written to '%s', use it with `--overlay %s` of train.py or test.py"
+                % (out_path, out_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="timed trials on thread counts and batch size, "
+                                                 "and write the fastest settings as a config overlay")
+    parser.add_argument('--config', '-c', required=False, dest='config_path', default='config/model_config.yaml')
+    parser.add_argument('--output', '-o', required=False, dest='out_path', default='config/autotune.yaml')
+    parser.add_argument('--modes', '-m', required=False, nargs='+', dest='modes', default=MODES, choices=MODES)
+    parser.add_argument('--threads', '-t', required=False, nargs='+', dest='threads', type=int,
+                        default=default_threads())
+    parser.add_argument('--interop_threads', '-i', required=False, nargs='+', dest='interop_threads', type=int,
+                        default=[1, 2])
+    parser.add_argument('--batch_sizes', '-b', required=False, nargs='+', dest='batch_sizes', type=int,
+                        default=[16, 32, 64])
+    parser.add_argument('--batch_num', '-n', required=False, dest='batch_num', type=int, default=5)
+    parser.add_argument('--warmup_num', '-w', required=False, dest='warmup_num', type=int, default=1)
+    args = parser.parse_args()
+
+    main(args.config_path, args.out_path, args.modes, args.threads, args.interop_threads, args.batch_sizes,
+         args.batch_num, args.warmup_num)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import copy
+import time
+import torch
+import logging
+import argparse
+from dataset.squad_dataset import SquadDataset
+from models.match_lstm import MatchLSTMModel
+from models.loss import MyNLLLoss
+from utils.load_config import init_logging, read_config
+from utils.eval import eval_on_model
+from utils.functions import quantize_dynamic_model
+
+init_logging()
+logger = logging.getLogger(__name__)
+
+MODES = ['fp32', 'bf16', 'int8', 'emb-fp16', 'emb-int8']
+TRAIN_MODES = ['fp32', 'bf16', 'emb-fp16', 'emb-int8']
+EMBEDDING_STORAGE = {'emb-fp16': 'float16', 'emb-int8': 'int8'}
+
+
+def load_model(global_config, mode):
+    """
+    construct model with weight loaded on cpu, and transform to the precision mode
+    :param global_config:
+    :param mode: 'fp32', 'bf16', 'int8', or 'emb-fp16' and 'emb-int8' that only change word embedding storage
+    :return:
+    """
+    if mode in EMBEDDING_STORAGE:
+        global_config = copy.deepcopy(global_config)
+        global_config['data']['embedding_storage'] = EMBEDDING_STORAGE[mode]
+
+    model = MatchLSTMModel(global_config)
+    model.eval()
+
+    model_weight_path = global_config['data']['model_path']
+    assert os.path.exists(model_weight_path), "not found model weight file on '%s'" % model_weight_path
+    weight = torch.load(model_weight_path, map_location=lambda storage, loc: storage)
+    model.load_state_dict(weight, strict=False)
+
+    if mode == 'int8':
+        model = quantize_dynamic_model(model)
+    elif mode == 'bf16':
+        model.enable_autocast = True
+    elif mode != 'fp32' and mode not in EMBEDDING_STORAGE:
+        raise ValueError('Unrecognized precision mode %s' % mode)
+
+    return model
+
+
+def embedding_memory(model):
+    """
+    memory bytes of word embedding table
+    :param model:
+    :return:
+    """
+    weight = model.embedding.embedding_layer.weight
+    mem_bytes = weight.numel() * weight.element_size()
+
+    weight_scale = model.embedding.weight_scale
+    if weight_scale is not None:
+        mem_bytes += weight_scale.numel() * weight_scale.element_size()
+    return mem_bytes
+
+
+def train_throughput(model, criterion, batch_data, enable_char, batch_char_func):
+    """
+    time forward and backward steps of training, without updating the weight
+    :return: (samples, seconds)
+    """
+    model.train()
+    device = torch.device('cpu')
+    samples_num = 0
+
+    start_time = time.time()
+    for batch in batch_data:
+        bat_context, bat_question, bat_context_char, bat_question_char, bat_answer_range = \
+            batch_char_func(batch, enable_char=enable_char, device=device)
+
+        model.zero_grad()
+        ans_range_prop, _, _ = model.forward(bat_context, bat_question, bat_context_char, bat_question_char)
+        loss = criterion.forward(ans_range_prop, bat_answer_range)
+        loss.backward()
+
+        samples_num += bat_answer_range.shape[0]
+    cost_time = time.time() - start_time
+
+    model.eval()
+    return samples_num, cost_time
+
+
+def main(config_path, modes, batch_num, train_batch_num):
+    logger.info('------------Benchmark Precision--------------')
+    logger.info('loading config file...')
+    global_config = read_config(config_path)
+    torch.manual_seed(global_config['model']['global']['random_seed'])
+
+    device = torch.device('cpu')
+    enable_char = global_config['model']['encoder']['enable_char']
+
+    logger.info('reading squad dataset...')
+    dataset = SquadDataset(global_config)
+    batch_dev_data = list(dataset.get_batch_dev(global_config['test']['batch_size']))
+    if batch_num is not None:
+        batch_dev_data = batch_dev_data[:batch_num]
+    samples_num = sum(map(lambda x: x[0].shape[0], batch_dev_data))
+
+    criterion = MyNLLLoss(multi_span=global_config['model']['output']['multi_span'],
+                          log_space=global_config['model']['output']['log_space'])
+    result = {}
+    for mode in modes:
+        logger.info('evaluating on %s...' % mode)
+        model = load_model(global_config, mode)
+
+        with torch.no_grad():
+            start_time = time.time()
+            score_em, score_f1, _ = eval_on_model(model=model,
+                                                  criterion=criterion,
+                                                  batch_data=batch_dev_data,
+                                                  epoch=None,
+                                                  device=device,
+                                                  enable_char=enable_char,
+                                                  batch_char_func=dataset.gen_batch_with_char)
+            cost_time = time.time() - start_time
+        result[mode] = (score_em, score_f1, cost_time, embedding_memory(model))
+        del model
+
+    # training throughput with the same weight
+    train_result = {}
+    if train_batch_num is not None:
+        batch_train_data = list(dataset.get_batch_train(global_config['train']['batch_size']))[:train_batch_num]
+        for mode in filter(lambda x: x in TRAIN_MODES, modes):
+            logger.info('training on %s...' % mode)
+            model = load_model(global_config, mode)
+            train_result[mode] = train_throughput(model=model,
+                                                  criterion=criterion,
+                                                  batch_data=batch_train_data,
+                                                  enable_char=enable_char,
+                                                  batch_char_func=dataset.gen_batch_with_char)
+            del model
+
+    # compare with the first mode
+    base_em, base_f1, base_time, _ = result[modes[0]]
+    logger.info('samples=%d, threads=%d' % (samples_num, torch.get_num_threads()))
+    logger.info('%-8s %8s %8s %10s %12s %8s %10s' % ('mode', 'em', 'f1', 'time(s)', 'samples/s', 'speedup',
+                                                     'emb(MB)'))
+    for mode in modes:
+        score_em, score_f1, cost_time, emb_bytes = result[mode]
+        logger.info('%-8s %8.4f %8.4f %10.2f %12.2f %8.2f %10.2f' % (mode, score_em, score_f1, cost_time,
+                                                                     samples_num / cost_time, base_time / cost_time,
+                                                                     emb_bytes / 1024. / 1024.))
+        if mode != modes[0]:
+            logger.info('%-8s delta_em=%.4f, delta_f1=%.4f' % (mode, score_em - base_em, score_f1 - base_f1))
+
+    for mode in train_result:
+        samples_num, cost_time = train_result[mode]
+        logger.info('%-8s train: samples=%d, time(s)=%.2f, samples/s=%.2f' % (mode, samples_num, cost_time,
+                                                                               samples_num / cost_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compare accuracy and latency of model with different precision")
+    parser.add_argument('--config', '-c', required=False, dest='config_path', default='config/model_config.yaml')
+    parser.add_argument('--modes', '-m', required=False, nargs='+', dest='modes', default=MODES, choices=MODES)
+    parser.add_argument('--batch_num', '-n', required=False, dest='batch_num', type=int, default=None)
+    parser.add_argument('--train_batch_num', '-t', required=False, dest='train_batch_num', type=int, default=None)
+    args = parser.parse_args()
+
+    main(args.config_path, args.modes, args.batch_num, args.train_batch_num)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import csv
+import logging
+import argparse
+import traceback
+import multiprocessing
+from dataset.squad_dataset import SquadDataset
+from utils.load_config import init_logging, read_config
+from train import train_process
+
+init_logging()
+logger = logging.getLogger(__name__)
+
+RESULT_FIELDS = ['name', 'overlay', 'epoch', 'loss', 'best_valid_em', 'best_valid_f1', 'early_stopped', 'time',
+                 'error']
+
+# datasets loaded before forking the pool, keyed by hdf5 path, workers read them with copy-on-write pages
+shared_datasets = {}
+
+
+def run_config(run):
+    """
+    train one config of the sweep on a pool worker, with the dataset loaded by the parent process
+    :param run: (name, overlay_path, global_config)
+    :return: dict of result, with the error message instead when training failed
+    """
+    name, overlay_path, global_config = run
+    result = {'name': name, 'overlay': overlay_path}
+    try:
+        logger.info("training '%s'..." % name)
+        dataset = shared_datasets[global_config['data']['dataset_h5']]
+        result.update(train_process(0, global_config, 1, dataset))
+        logger.info("finished '%s', best_valid_f1=%s" % (name, result['best_valid_f1']))
+    except Exception:
+        logger.error("failed '%s'\n%s" % (name, traceback.format_exc()))
+        result['error'] = traceback.format_exc().strip().split('\n')[-1]
+    return result
+
+
+def build_runs(config_path, overlay_paths, out_dir, processes, num_threads):
+    """
+    config of every run, with its own output paths under out_dir/<name>.
+    every run trains on one process, and the cpu is split between the concurrent runs by default
+    :return: list of (name, overlay_path, global_config)
+    """
+    if num_threads <= 0:
+        num_threads = max(1, os.cpu_count() // processes)
+
+    runs = []
+    mmap_datasets = {}  # hdf5 file of each memory-mapped glove table
+    for overlay_path in overlay_paths:
+        name = os.path.splitext(os.path.basename(overlay_path))[0]
+        if name in map(lambda x: x[0], runs):
+            raise ValueError("run name '%s' of '%s' is duplicated" % (name, overlay_path))
+
+        global_config = read_config(config_path, [overlay_path])
+        run_dir = os.path.join(out_dir, name)
+        os.makedirs(run_dir, exist_ok=True)
+        global_config['data']['model_path'] = os.path.join(run_dir, 'model-weight.pt')
+        if global_config['data']['checkpoint_path'] is not None:
+            global_config['data']['checkpoint_path'] = os.path.join(run_dir, 'checkpoint.pt')
+        if global_config['train']['metrics_path'] is not None:
+            global_config['train']['metrics_path'] = os.path.join(run_dir, 'train-metrics.jsonl')
+
+        # a table exported from one dataset is not reused by another, the later one is put beside its hdf5 file
+        dataset_h5 = os.path.abspath(global_config['data']['dataset_h5'])
+        mmap_path = global_config['data']['embedding_mmap_path']
+        if mmap_path is not None and mmap_datasets.setdefault(mmap_path, dataset_h5) != dataset_h5:
+            mmap_path = '%s.id2vec.npy' % os.path.splitext(dataset_h5)[0]
+            if mmap_datasets.setdefault(mmap_path, dataset_h5) != dataset_h5:
+                raise ValueError("glove table '%s' of '%s' is used by another dataset" % (mmap_path, dataset_h5))
+            global_config['data']['embedding_mmap_path'] = mmap_path
+
+        global_config['train']['world_size'] = 1
+        global_config['train']['async_valid'] = False  # pool workers could not start processes
+        if global_config['train']['num_threads'] <= 0:
+            global_config['train']['num_threads'] = num_threads
+
+        runs.append((name, overlay_path, global_config))
+    return runs
+
+
+def write_results(results, out_path):
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for r in results:
+            writer.writerow(r)
+
+
+def format_value(value, fmt):
+    return '-' if value is None else fmt % value
+
+
+def main(config_path, overlay_paths, out_dir, processes, num_threads):
+    logger.info('------------Sweep--------------')
+    logger.info('loading config files...')
+    runs = build_runs(config_path, overlay_paths, out_dir, processes, num_threads)
+
+    # only numpy arrays are loaded here, no torch parallel work starts before fork
+    for _, _, global_config in runs:
+        dataset_h5 = global_config['data']['dataset_h5']
+        if dataset_h5 not in shared_datasets:
+            logger.info("reading squad dataset '%s'..." % dataset_h5)
+            shared_datasets[dataset_h5] = SquadDataset(global_config)
+
+    # forked workers share the dataset, and the glove table of each dataset when `embedding_mmap_path` is set.
+    # a new process for every run, since the inter-op threads of torch could only be set once in a process
+    logger.info('training %d configs on %d processes...' % (len(runs), processes))
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(processes, maxtasksperchild=1) as pool:
+        results = pool.map(run_config, runs, chunksize=1)
+
+    out_path = os.path.join(out_dir, 'sweep.csv')
+    write_results(results, out_path)
+
+    logger.info('%-20s %8s %10s %10s %10s' % ('name', 'epoch', 'loss', 'em', 'f1'))
+    for r in results:
+        if 'error' in r:
+            logger.info('%-20s failed: %s' % (r['name'], r['error']))
+            continue
+        logger.info('%-20s %8d %10s %10s %10s' % (r['name'], r['epoch'], format_value(r['loss'], '%.5f'),
+                                                  format_value(r['best_valid_em'], '%.2f'),
+                                                  format_value(r['best_valid_f1'], '%.2f')))
+    logger.info("results written to '%s'" % out_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="train several config overlays concurrently on a process pool "
+                                                 "sharing the dataset, and collect results to a csv table")
+    parser.add_argument('--config', '-c', required=False, dest='config_path', default='config/model_config.yaml')
+    parser.add_argument('--overlays', '-o', required=True, nargs='+', dest='overlay_paths',
+                        help='config files override part of config, one run for each')
+    parser.add_argument('--output', '-d', required=False, dest='out_dir', default='data/sweep')
+    parser.add_argument('--processes', '-p', required=False, dest='processes', type=int, default=2)
+    parser.add_argument('--threads', '-t', required=False, dest='num_threads', type=int, default=0,
+                        help='intra-op threads of each run without num_threads, 0 to split cpu between processes')
+    args = parser.parse_args()
+
+    main(args.config_path, args.overlay_paths, args.out_dir, args.processes, args.num_threads)
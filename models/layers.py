@@ -3,13 +3,18 @@
 
 __author__ = 'han'
 
+import os
+import json
 import math
 import h5py
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import numpy as np
+from collections import OrderedDict
 from dataset.preprocess_data import PreprocessData
-from utils.functions import masked_softmax, compute_mask, masked_flip
+from utils.functions import masked_softmax, masked_log_softmax, compute_mask, masked_flip, \
+    convert_embedding_storage
 
 
 class GloveEmbedding(torch.nn.Module):
@@ -17,6 +22,10 @@ class GloveEmbedding(torch.nn.Module):
     Glove Embedding Layer, also compute the mask of padding index
     Args:
         - dataset_h5_path: glove embedding file path
+        - mmap_path: If not ``None``, load the frozen embeddings from a memory-mapped file,
+          that shared by os page cache across processes. Default: ``None``
+        - storage: 'float32', 'float16' or 'int8' with row-wise scale, the type that embeddings stored in memory.
+          Embeddings are always converted to float32 on lookup. Default: ``'float32'``
     Inputs:
         **input** (batch, seq_len): sequence with word index
     Outputs
@@ -24,28 +33,111 @@ class GloveEmbedding(torch.nn.Module):
         **mask** (batch, seq_len): tensor that show which index is padding
     """
 
-    def __init__(self, dataset_h5_path):
+    def __init__(self, dataset_h5_path, mmap_path=None, storage='float32'):
         super(GloveEmbedding, self).__init__()
         self.dataset_h5_path = dataset_h5_path
-        n_embeddings, len_embedding, weights = self.load_glove_hdf5()
+        self.mmap_path = mmap_path
+        self.storage = storage
+        if mmap_path is None:
+            id2vec, id2vec_scale = self.load_glove_hdf5()
+        else:
+            id2vec, id2vec_scale = self.load_glove_mmap()
+        n_embeddings, len_embedding = id2vec.shape
 
         self.embedding_layer = torch.nn.Embedding(num_embeddings=n_embeddings, embedding_dim=len_embedding)
-        self.embedding_layer.weight = torch.nn.Parameter(weights)
-        self.embedding_layer.weight.requires_grad = False
+        self.embedding_layer.weight = torch.nn.Parameter(torch.from_numpy(id2vec), requires_grad=False)
+
+        # row-wise scale of int8 storage, not saved with model weight
+        weight_scale = torch.from_numpy(id2vec_scale) if id2vec_scale is not None else None
+        self.register_buffer('weight_scale', weight_scale, persistent=False)
 
     def load_glove_hdf5(self):
+        """
+        load glove embeddings from hdf5 file, and convert to the storage type
+        :return: (id2vec, id2vec_scale), where id2vec_scale is None when not int8 storage
+        """
         with h5py.File(self.dataset_h5_path, 'r') as f:
             f_meta_data = f['meta_data']
             id2vec = np.array(f_meta_data['id2vec'])  # only need 1.11s
-            word_dict_size = f.attrs['word_dict_size']
-            embedding_size = f.attrs['embedding_size']
+            id2vec_scale = np.array(f_meta_data['id2vec_scale']) if 'id2vec_scale' in f_meta_data else None
 
-        return int(word_dict_size), int(embedding_size), torch.from_numpy(id2vec)
+        return convert_embedding_storage(id2vec, id2vec_scale, self.storage)
+
+    def load_glove_mmap(self):
+        """
+        load glove embeddings with memory-mapped npy file, export it from hdf5 file when not exist or exported
+        from another hdf5 file, that recorded in a json file beside it
+        :return: (id2vec, id2vec_scale), where id2vec_scale is None when not int8 storage
+        """
+        vec_path = self.mmap_path
+        if self.storage != 'float32':
+            vec_root, vec_ext = os.path.splitext(self.mmap_path)
+            vec_path = '%s.%s%s' % (vec_root, self.storage, vec_ext)
+        scale_path = '%s.scale%s' % os.path.splitext(vec_path)
+        source_path = '%s.json' % os.path.splitext(vec_path)[0]
+
+        h5_stat = os.stat(self.dataset_h5_path)
+        source = {'dataset_h5': os.path.abspath(self.dataset_h5_path),
+                  'size': h5_stat.st_size,
+                  'mtime': h5_stat.st_mtime}
+        if self.read_json(source_path) != source:
+            id2vec, id2vec_scale = self.load_glove_hdf5()
+
+            # source last, make sure the embedding and scale files are complete when it matches
+            if id2vec_scale is not None:
+                self.export_npy(scale_path, id2vec_scale)
+            self.export_npy(vec_path, id2vec)
+            self.export_json(source_path, source)
+
+        # copy-on-write mapping, pages keep shared since the weight is never modified
+        id2vec = np.load(vec_path, mmap_mode='c')
+        id2vec_scale = np.load(scale_path) if self.storage == 'int8' else None
+
+        with h5py.File(self.dataset_h5_path, 'r') as f:
+            shape = (int(f.attrs['word_dict_size']), int(f.attrs['embedding_size']))
+        if id2vec.shape != shape:
+            raise ValueError("glove table '%s' has shape %s, but %s expected by '%s'"
+                             % (vec_path, id2vec.shape, shape, self.dataset_h5_path))
+        return id2vec, id2vec_scale
+
+    @staticmethod
+    def read_json(path):
+        """
+        :param path:
+        :return: the json object, or None when not exist or broken
+        """
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def export_json(path, obj):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def export_npy(path, array):
+        """
+        write to temp file then rename, make sure other processes never map a partial file
+        :param path:
+        :param array:
+        :return:
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
 
     def forward(self, x):
         mask = compute_mask(x, PreprocessData.padding_idx)
 
-        tmp_emb = self.embedding_layer.forward(x)
+        tmp_emb = self.embedding_layer.forward(x).float()
+        if self.weight_scale is not None:
+            tmp_emb = tmp_emb * self.weight_scale[x].unsqueeze(-1)  # dequantize int8 storage
         out_emb = tmp_emb.transpose(0, 1)
 
         return out_emb, mask
@@ -130,6 +222,9 @@ class CharEncoder(torch.nn.Module):
 class CharCNN(torch.nn.Module):
     """
     Char-level CNN
+    Args:
+        - width_invariant: If ``True``, max-pool only on windows starting inside each word, so that the encoding
+          of a word is the same whatever the padded char width of batch. Default: ``False``
     Inputs:
         **input** (batch, seq_len, word_len, embedding_size)
         **char_mask** (batch, seq_len, word_len)
@@ -138,9 +233,11 @@ class CharCNN(torch.nn.Module):
         **output** (seq_len, batch, hidden_size)
     """
 
-    def __init__(self, emb_size, filters_size, filters_num, dropout_p):
+    def __init__(self, emb_size, filters_size, filters_num, dropout_p, width_invariant=False):
         super(CharCNN, self).__init__()
 
+        self.filters_size = filters_size
+        self.width_invariant = width_invariant
         self.dropout = torch.nn.Dropout(p=dropout_p)
         self.cnns = torch.nn.ModuleList(
             [torch.nn.Conv2d(1, fn, (fw, emb_size)) for fw, fn in zip(filters_size, filters_num)])
@@ -148,10 +245,23 @@ class CharCNN(torch.nn.Module):
     def forward(self, x, char_mask, word_mask):
         x = self.dropout(x)
 
+        # at least one window of the widest filter
+        max_fw = max(self.filters_size)
+        if x.shape[2] < max_fw:
+            x = F.pad(x, (0, 0, 0, max_fw - x.shape[2]))
+
         batch_size, seq_len, word_len, embedding_size = x.shape
         x = x.view(-1, word_len, embedding_size).unsqueeze(1)  # (N, 1, word_len, embedding_size)
 
         x = [F.relu(cnn(x)).squeeze(-1) for cnn in self.cnns]  # (N, Cout, word_len - fw + 1) * fn
+
+        # max-pool on windows starting inside the word, or the first window of a shorter word
+        if self.width_invariant:
+            char_len = char_mask.reshape(-1, char_mask.shape[2]).sum(1).long()  # (N,)
+            for i, fw in enumerate(self.filters_size):
+                positions = torch.arange(x[i].shape[2], device=x[i].device).unsqueeze(0)  # (1, word_len - fw + 1)
+                windows_mask = positions < (char_len - fw + 1).clamp(min=1).unsqueeze(1)  # (N, word_len - fw + 1)
+                x[i] = x[i].masked_fill(~windows_mask.unsqueeze(1), 0.)  # relu output is never negative
         x = [torch.max(cx, 2)[0] for cx in x]  # (N, Cout) * fn
         x = torch.cat(x, dim=1)  # (N, hidden_size)
 
@@ -192,7 +302,8 @@ class CharCNNEncoder(torch.nn.Module):
         **output** (seq_len, batch, hidden_size)
     """
 
-    def __init__(self, emb_size, hidden_size, filters_size, filters_num, dropout_p, enable_highway=True):
+    def __init__(self, emb_size, hidden_size, filters_size, filters_num, dropout_p, enable_highway=True,
+                 width_invariant=False):
         super(CharCNNEncoder, self).__init__()
         self.enable_highway = enable_highway
         self.hidden_size = hidden_size
@@ -200,7 +311,8 @@ class CharCNNEncoder(torch.nn.Module):
         self.cnn = CharCNN(emb_size=emb_size,
                            filters_size=filters_size,
                            filters_num=filters_num,
-                           dropout_p=dropout_p)
+                           dropout_p=dropout_p,
+                           width_invariant=width_invariant)
 
         if enable_highway:
             self.highway = Highway(in_size=hidden_size,
@@ -217,6 +329,67 @@ class CharCNNEncoder(torch.nn.Module):
         return o
 
 
+class CharEncodingCache:
+    """
+    LRU cache of char-level word encodings, used when predicting. The cache is keyed by word index,
+    and cleared automatically when the watched weights changed. It relies on the char encoder giving the same
+    encoding of a word whatever the padded char width of batch, see `width_invariant` of `CharCNN`.
+    Args:
+        - max_size: The max number of words cached
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.weight_version = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def check_weight(self, params):
+        """
+        clear the cache if any parameter is replaced or modified in-place, such as optimizer step or load weight
+        :param params: parameters that encodings depend on
+        :return:
+        """
+        version = tuple((p.data_ptr(), p._version) for p in params)
+        if version != self.weight_version:
+            self.cache.clear()
+            self.weight_version = version
+
+    def get(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.cache.clear()
+        self.weight_version = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.cache),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits * 1. / lookups if lookups > 0 else 0.}
+
+
 class MatchRNNAttention(torch.nn.Module):
     r"""
     attention mechanism in match-rnn
@@ -259,6 +432,8 @@ class UniMatchRNN(torch.nn.Module):
     Args:
         - input_size: The number of expected features in the input Hp and Hq
         - hidden_size: The number of features in the hidden state Hr
+        - checkpoint_steps: If ``> 0``, only keep hidden state every k steps when training,
+          and recompute the steps between them on backward to save memory. Default: ``0``
 
     Inputs:
         Hp(context_len, batch, input_size): context encoded
@@ -269,12 +444,13 @@ class UniMatchRNN(torch.nn.Module):
         alpha(batch, question_len, context_len): used for visual show
     """
 
-    def __init__(self, mode, input_size, hidden_size, gated_attention, mlp_attention):
+    def __init__(self, mode, input_size, hidden_size, gated_attention, mlp_attention, checkpoint_steps=0):
         super(UniMatchRNN, self).__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.gated_attention = gated_attention
         self.mlp_attention = mlp_attention
+        self.checkpoint_steps = checkpoint_steps
 
         assert gated_attention != mlp_attention, 'mlp-attention and gated-attention only choose one'
 
@@ -312,10 +488,43 @@ class UniMatchRNN(torch.nn.Module):
 
         # init hidden with the same type of input data
         h_0 = Hq.new_zeros(batch_size, self.hidden_size)
-        hidden = [(h_0, h_0)] if self.mode == 'LSTM' else [h_0]
+        hidden = (h_0, h_0) if self.mode == 'LSTM' else (h_0,)
+
+        # split context to segments, and only keep the segment boundary hidden state when checkpoint
+        enable_checkpoint = self.checkpoint_steps > 0 and self.training and torch.is_grad_enabled()
+        seg_len = self.checkpoint_steps if enable_checkpoint else max(context_len, 1)
+
+        result = []
+        vis_alpha = []
+        for s in range(0, context_len, seg_len):
+            cur_hp = Hp[s:(s + seg_len), ...]
+            if enable_checkpoint:
+                seg_out = torch.utils.checkpoint.checkpoint(self.forward_steps, cur_hp, Hq, Hq_mask, *hidden,
+                                                            use_reentrant=False)
+            else:
+                seg_out = self.forward_steps(cur_hp, Hq, Hq_mask, *hidden)
+
+            result.append(seg_out[0])
+            vis_alpha.append(seg_out[1])
+            hidden = seg_out[2:]
+
+        result = torch.cat(result, dim=0)  # (context_len, batch, hidden_size)
+        vis_alpha = torch.cat(vis_alpha, dim=2)  # (batch, question_len, context_len)
+        return result, vis_alpha
+
+    def forward_steps(self, Hp, Hq, Hq_mask, *hidden_0):
+        """
+        run match-rnn steps on a segment of context
+        :param Hp: (seg_len, batch, input_size)
+        :param Hq: (question_len, batch, input_size)
+        :param Hq_mask: (batch, question_len)
+        :param hidden_0: init hidden state, (h_0, c_0) when lstm or (h_0,) when gru
+        :return: (hidden_state, vis_alpha, *last_hidden)
+        """
+        hidden = [hidden_0] if self.mode == 'LSTM' else [hidden_0[0]]
         vis_alpha = []
 
-        for t in range(context_len):
+        for t in range(Hp.shape[0]):
             cur_hp = Hp[t, ...]  # (batch, input_size)
             attention_input = hidden[t][0] if self.mode == 'LSTM' else hidden[t]
 
@@ -338,11 +547,12 @@ class UniMatchRNN(torch.nn.Module):
             cur_hidden = self.hidden_cell.forward(cur_z, hidden[t])  # (batch, hidden_size), when lstm output tuple
             hidden.append(cur_hidden)
 
-        vis_alpha = torch.stack(vis_alpha, dim=2)  # (batch, question_len, context_len)
+        vis_alpha = torch.stack(vis_alpha, dim=2)  # (batch, question_len, seg_len)
 
         hidden_state = list(map(lambda x: x[0], hidden)) if self.mode == 'LSTM' else hidden
-        result = torch.stack(hidden_state[1:], dim=0)  # (context_len, batch, hidden_size)
-        return result, vis_alpha
+        result = torch.stack(hidden_state[1:], dim=0)  # (seg_len, batch, hidden_size)
+        last_hidden = tuple(hidden[-1]) if self.mode == 'LSTM' else (hidden[-1],)
+        return (result, vis_alpha) + last_hidden
 
 
 class MatchRNN(torch.nn.Module):
@@ -354,6 +564,7 @@ class MatchRNN(torch.nn.Module):
         - bidirectional: If ``True``, becomes a bidirectional RNN. Default: ``False``
         - gated_attention: If ``True``, gated attention used, see more on R-NET
         - mlp_attention: Customized parameter. If ``True``, add one mlp layer after attention before rnn
+        - checkpoint_steps: If ``> 0``, gradient checkpointing on every k steps when training. Default: ``0``
 
     Inputs:
         Hp(context_len, batch, input_size): context encoded
@@ -365,14 +576,17 @@ class MatchRNN(torch.nn.Module):
         Hr(context_len, batch, hidden_size * num_directions): question-aware context representation
     """
 
-    def __init__(self, mode, input_size, hidden_size, bidirectional, gated_attention, mlp_attention, dropout_p):
+    def __init__(self, mode, input_size, hidden_size, bidirectional, gated_attention, mlp_attention, dropout_p,
+                 checkpoint_steps=0):
         super(MatchRNN, self).__init__()
         self.bidirectional = bidirectional
         self.num_directions = 1 if bidirectional else 2
 
-        self.left_match_rnn = UniMatchRNN(mode, input_size, hidden_size, gated_attention, mlp_attention)
+        self.left_match_rnn = UniMatchRNN(mode, input_size, hidden_size, gated_attention, mlp_attention,
+                                          checkpoint_steps)
         if bidirectional:
-            self.right_match_rnn = UniMatchRNN(mode, input_size, hidden_size, gated_attention, mlp_attention)
+            self.right_match_rnn = UniMatchRNN(mode, input_size, hidden_size, gated_attention, mlp_attention,
+                                               checkpoint_steps)
 
         self.dropout = torch.nn.Dropout(p=dropout_p)
 
@@ -409,24 +623,29 @@ class PointerAttention(torch.nn.Module):
     Args:
         - input_size: The number of features in Hr
         - hidden_size: The number of features in the hidden layer
+        - log_space: If ``True``, output log-probability with masked log softmax
 
     Inputs:
         Hr(context_len, batch, hidden_size * num_directions): question-aware context representation
         Hk_last(batch, hidden_size): the last hidden output of previous time
+        wr_hr(context_len, batch, hidden_size): optional, context projection precomputed with `linear_wr`,
+            that could be reused on every answer step
 
     Outputs:
         beta(batch, context_len): question-aware context representation
     """
 
-    def __init__(self, input_size, hidden_size):
+    def __init__(self, input_size, hidden_size, log_space=False):
         super(PointerAttention, self).__init__()
+        self.log_space = log_space
 
         self.linear_wr = torch.nn.Linear(input_size, hidden_size)
         self.linear_wa = torch.nn.Linear(hidden_size, hidden_size)
         self.linear_wf = torch.nn.Linear(hidden_size, 1)
 
-    def forward(self, Hr, Hr_mask, Hk_pre):
-        wr_hr = self.linear_wr(Hr)  # (context_len, batch, hidden_size)
+    def forward(self, Hr, Hr_mask, Hk_pre, wr_hr=None):
+        if wr_hr is None:
+            wr_hr = self.linear_wr(Hr)  # (context_len, batch, hidden_size)
         wa_ha = self.linear_wa(Hk_pre).unsqueeze(0)  # (1, batch, hidden_size)
         f = F.tanh(wr_hr + wa_ha)  # (context_len, batch, hidden_size)
 
@@ -434,7 +653,10 @@ class PointerAttention(torch.nn.Module):
             .squeeze(2) \
             .transpose(0, 1)  # (batch, context_len)
 
-        beta = masked_softmax(beta_tmp, m=Hr_mask, dim=1)
+        if self.log_space:
+            beta = masked_log_softmax(beta_tmp, m=Hr_mask, dim=1)
+        else:
+            beta = masked_softmax(beta_tmp, m=Hr_mask, dim=1)
         return beta
 
 
@@ -462,6 +684,7 @@ class UniBoundaryPointer(torch.nn.Module):
     Args:
         - input_size: The number of features in Hr
         - hidden_size: The number of features in the hidden layer
+        - log_space: If ``True``, output log-probability
 
     Inputs:
         Hr(context_len, batch, hidden_size * num_directions): question-aware context representation
@@ -471,13 +694,14 @@ class UniBoundaryPointer(torch.nn.Module):
     """
     answer_len = 2
 
-    def __init__(self, mode, input_size, hidden_size):
+    def __init__(self, mode, input_size, hidden_size, log_space=False):
         super(UniBoundaryPointer, self).__init__()
 
         self.input_size = input_size
         self.hidden_size = hidden_size
+        self.log_space = log_space
 
-        self.attention = PointerAttention(input_size, hidden_size)
+        self.attention = PointerAttention(input_size, hidden_size, log_space)
 
         self.mode = mode
         if mode == 'LSTM':
@@ -510,11 +734,17 @@ class UniBoundaryPointer(torch.nn.Module):
         hidden = (h_0, h_0) if self.mode == 'LSTM' else h_0
         beta_out = []
 
+        # context projection is the same on every answer step
+        wr_hr = self.attention.linear_wr(Hr)  # (context_len, batch, hidden_size)
+
         for t in range(self.answer_len):
             attention_input = hidden[0] if self.mode == 'LSTM' else hidden
-            beta = self.attention.forward(Hr, Hr_mask, attention_input)  # (batch, context_len)
+            beta = self.attention.forward(Hr, Hr_mask, attention_input, wr_hr)  # (batch, context_len)
             beta_out.append(beta)
 
+            # attention pooling still needs probability
+            if self.log_space:
+                beta = beta.exp()
             context_beta = torch.bmm(beta.unsqueeze(1), Hr.transpose(0, 1)) \
                 .squeeze(1)  # (batch, input_size)
 
@@ -525,15 +755,35 @@ class UniBoundaryPointer(torch.nn.Module):
 
 
 class BoundaryPointer(torch.nn.Module):
+    r"""
+    boundary Pointer Net with one or two directions. When bidirectional, the two directions share one context
+    projection matmul, and their answer steps run batched on a direction dim
+    Args:
+        - mode: LSTM or GRU
+        - input_size: The number of features in Hr
+        - hidden_size: The number of features in the hidden layer
+        - bidirectional: If ``True``, the second direction predicts end position first
+        - log_space: If ``True``, output masked log-probability, and the two directions are averaged
+          on probability with logaddexp. Default: ``False``
 
-    def __init__(self, mode, input_size, hidden_size, bidirectional, dropout_p):
+    Inputs:
+        Hr(context_len, batch, hidden_size * num_directions): question-aware context representation
+        Hr_mask(batch, context_len): each context valued length without padding values
+        h_0(batch, hidden_size * ptr_directions): init lstm cell hidden state
+    Outputs:
+        **output** (answer_len, batch, context_len): start and end answer index possibility position in context
+    """
+
+    def __init__(self, mode, input_size, hidden_size, bidirectional, dropout_p, log_space=False):
         super(BoundaryPointer, self).__init__()
         self.bidirectional = bidirectional
         self.hidden_size = hidden_size
+        self.mode = mode
+        self.log_space = log_space
 
-        self.left_ptr_rnn = UniBoundaryPointer(mode, input_size, hidden_size)
+        self.left_ptr_rnn = UniBoundaryPointer(mode, input_size, hidden_size, log_space)
         if bidirectional:
-            self.right_ptr_rnn = UniBoundaryPointer(mode, input_size, hidden_size)
+            self.right_ptr_rnn = UniBoundaryPointer(mode, input_size, hidden_size, log_space)
 
         self.dropout = torch.nn.Dropout(p=dropout_p)
 
@@ -547,13 +797,25 @@ class BoundaryPointer(torch.nn.Module):
             assert self.hidden_size * 2 == h_0.shape[1]
             h_0_left, h_0_right = list(torch.split(h_0, self.hidden_size, dim=1))
 
-        left_beta = self.left_ptr_rnn.forward(Hr, Hr_mask, h_0_left)
+        if self.bidirectional and self.batch_directions_enabled():
+            left_beta, right_beta_inv = self.forward_batched(Hr, Hr_mask, h_0_left, h_0_right)
+        else:
+            left_beta = self.left_ptr_rnn.forward(Hr, Hr_mask, h_0_left)
+            if self.bidirectional:
+                right_beta_inv = self.right_ptr_rnn.forward(Hr, Hr_mask, h_0_right)
+
         rtn_beta = left_beta
         if self.bidirectional:
-            right_beta_inv = self.right_ptr_rnn.forward(Hr, Hr_mask, h_0_right)
             right_beta = right_beta_inv[[1, 0], :]
 
-            rtn_beta = (left_beta + right_beta) / 2
+            if self.log_space:
+                rtn_beta = torch.logaddexp(left_beta, right_beta) - math.log(2)
+            else:
+                rtn_beta = (left_beta + right_beta) / 2
+
+        # masked log-probability is finite already
+        if self.log_space:
+            return rtn_beta
 
         # todo: unexplainable
         new_mask = torch.neg((Hr_mask - 1) * 1e-6)  # mask replace zeros with 1e-6, make sure no gradient explosion
@@ -561,6 +823,84 @@ class BoundaryPointer(torch.nn.Module):
 
         return rtn_beta
 
+    def batch_directions_enabled(self):
+        """
+        directions could only be batched with float weights, not with quantized modules
+        :return:
+        """
+        cell_type = torch.nn.LSTMCell if self.mode == 'LSTM' else torch.nn.GRUCell
+        for ptr_rnn in [self.left_ptr_rnn, self.right_ptr_rnn]:
+            if type(ptr_rnn.hidden_cell) is not cell_type:
+                return False
+            for linear in [ptr_rnn.attention.linear_wr, ptr_rnn.attention.linear_wa, ptr_rnn.attention.linear_wf]:
+                if type(linear) is not torch.nn.Linear:
+                    return False
+        return True
+
+    def forward_batched(self, Hr, Hr_mask, h_0_left=None, h_0_right=None):
+        """
+        run the two directions of pointer net on a stacked direction dim, same with each UniBoundaryPointer
+        :return: (left_beta, right_beta_inv), each (answer_len, batch, context_len)
+        """
+        context_len, batch_size, _ = Hr.shape
+        ptr_rnns = [self.left_ptr_rnn, self.right_ptr_rnn]
+        attentions = [x.attention for x in ptr_rnns]
+        cells = [x.hidden_cell for x in ptr_rnns]
+
+        # context projection of both directions in one matmul: (context_len, batch, 2, hidden_size)
+        wr_weight = torch.cat([x.linear_wr.weight for x in attentions], dim=0)
+        wr_bias = torch.cat([x.linear_wr.bias for x in attentions], dim=0)
+        wr_hr = F.linear(Hr, wr_weight, wr_bias).view(context_len, batch_size, 2, self.hidden_size)
+
+        # stacked weights on direction dim
+        wa_weight = torch.stack([x.linear_wa.weight for x in attentions], dim=0)  # (2, hidden_size, hidden_size)
+        wa_bias = torch.stack([x.linear_wa.bias for x in attentions], dim=0).unsqueeze(1)
+        wf_weight = torch.cat([x.linear_wf.weight for x in attentions], dim=0)  # (2, hidden_size)
+        wf_bias = torch.cat([x.linear_wf.bias for x in attentions], dim=0)  # (2,)
+        ih_weight = torch.stack([x.weight_ih for x in cells], dim=0)  # (2, gate_size, input_size)
+        ih_bias = torch.stack([x.bias_ih for x in cells], dim=0).unsqueeze(1)
+        hh_weight = torch.stack([x.weight_hh for x in cells], dim=0)  # (2, gate_size, hidden_size)
+        hh_bias = torch.stack([x.bias_hh for x in cells], dim=0).unsqueeze(1)
+
+        h_0_dirs = [x if x is not None else Hr.new_zeros(batch_size, self.hidden_size) for x in [h_0_left, h_0_right]]
+        hidden = torch.stack(h_0_dirs, dim=0)  # (2, batch, hidden_size)
+        cell_state = hidden
+        Hr_batch = Hr.transpose(0, 1)  # (batch, context_len, input_size)
+        beta_mask = Hr_mask.unsqueeze(1)  # (batch, 1, context_len)
+
+        beta_out = []
+        for t in range(UniBoundaryPointer.answer_len):
+            wa_ha = torch.baddbmm(wa_bias, hidden, wa_weight.transpose(1, 2))  # (2, batch, hidden_size)
+            f = F.tanh(wr_hr + wa_ha.transpose(0, 1).unsqueeze(0))  # (context_len, batch, 2, hidden_size)
+
+            beta_tmp = ((f * wf_weight).sum(-1) + wf_bias).permute(1, 2, 0)  # (batch, 2, context_len)
+            if self.log_space:
+                beta = masked_log_softmax(beta_tmp, m=beta_mask, dim=2)
+                beta_out.append(beta)
+                beta = beta.exp()
+            else:
+                beta = masked_softmax(beta_tmp, m=beta_mask, dim=2)
+                beta_out.append(beta)
+
+            context_beta = torch.bmm(beta, Hr_batch).transpose(0, 1)  # (2, batch, input_size)
+
+            gate_i = torch.baddbmm(ih_bias, context_beta, ih_weight.transpose(1, 2))
+            gate_h = torch.baddbmm(hh_bias, hidden, hh_weight.transpose(1, 2))
+            if self.mode == 'LSTM':
+                in_gate, forget_gate, cell_gate, out_gate = (gate_i + gate_h).chunk(4, dim=2)
+                cell_state = F.sigmoid(forget_gate) * cell_state + F.sigmoid(in_gate) * F.tanh(cell_gate)
+                hidden = F.sigmoid(out_gate) * F.tanh(cell_state)
+            else:
+                i_r, i_z, i_n = gate_i.chunk(3, dim=2)
+                h_r, h_z, h_n = gate_h.chunk(3, dim=2)
+                reset_gate = F.sigmoid(i_r + h_r)
+                update_gate = F.sigmoid(i_z + h_z)
+                new_gate = F.tanh(i_n + reset_gate * h_n)
+                hidden = (1 - update_gate) * new_gate + update_gate * hidden
+
+        result = torch.stack(beta_out, dim=0)  # (answer_len, batch, 2, context_len)
+        return result[:, :, 0], result[:, :, 1]
+
 
 class MyRNNBase(torch.nn.Module):
     """
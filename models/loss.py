@@ -4,31 +4,45 @@
 __author__ = 'han'
 
 import torch
-import torch.nn.functional as F
+from dataset.preprocess_data import PreprocessData
 
 
 class MyNLLLoss(torch.nn.modules.loss._Loss):
     """
     a standard negative log likelihood loss. It is useful to train a classification
     problem with `C` classes.
+    Args:
+        - multi_span: If ``True``, y_true could carry several candidate answers padding with -1,
+          and loss is the negative log of their summed likelihood. Otherwise only the first answer used.
+          Default: ``False``
+        - log_space: If ``True``, y_pred is already log-probability, such as output of the pointer net
+          with `log_space`. Default: ``False``
 
     Shape:
         - y_pred: (batch, answer_len, prob)
-        - y_true: (batch, answer_len)
+        - y_true: (batch, answer_len), or (batch, answer_len * candidate_num) when multi_span
         - output: loss
     """
-    def __init__(self):
+    def __init__(self, multi_span=False, log_space=False):
         super(MyNLLLoss, self).__init__()
+        self.multi_span = multi_span
+        self.log_space = log_space
 
     def forward(self, y_pred, y_true):
-        torch.nn.modules.loss._assert_no_grad(y_true)
+        y_true = y_true.detach()
+        answer_len = y_pred.shape[1]
+        if not self.multi_span:
+            y_true = y_true[:, :answer_len]
 
-        y_pred_log = torch.log(y_pred)
-        loss = []
-        for i in range(y_pred.shape[0]):
-            tmp_loss = F.nll_loss(y_pred_log[i], y_true[i], reduce=False)
-            one_loss = tmp_loss[0] + tmp_loss[1]
-            loss.append(one_loss)
+        y_pred_log = y_pred.float() if self.log_space else torch.log(y_pred.float())
 
-        loss_stack = torch.stack(loss)
-        return torch.mean(loss_stack)
\ No newline at end of file
+        # (batch, candidate_num, answer_len)
+        y_true = y_true.view(y_true.shape[0], -1, answer_len)
+        y_valid = y_true[:, :, 0].ne(PreprocessData.answer_padding_idx)
+
+        # gather log-probability of every start and end in one op: (batch, answer_len, candidate_num)
+        y_true_log = y_pred_log.gather(2, y_true.clamp(min=0).transpose(1, 2))
+        span_log = y_true_log.sum(1).masked_fill(~y_valid, float('-inf'))  # (batch, candidate_num)
+
+        loss = -torch.logsumexp(span_log, dim=1)
+        return torch.mean(loss)
@@ -7,7 +7,7 @@ import torch
 import torch.nn as nn
 from models.layers import *
 from dataset.preprocess_data import PreprocessData
-from utils.functions import answer_search
+from utils.functions import answer_search, compute_mask, window_starts
 
 
 class MatchLSTMModel(torch.nn.Module):
@@ -45,9 +45,12 @@ class MatchLSTMModel(torch.nn.Module):
         char_cnn_filter_size = global_config['model']['encoder']['char_cnn_filter_size']
         char_cnn_filter_num = global_config['model']['encoder']['char_cnn_filter_num']
         self.enable_char = global_config['model']['encoder']['enable_char']
+        char_cache_size = global_config['model']['encoder']['char_cache_size']
+        char_width_invariant = global_config['model']['encoder']['char_width_invariant']
 
         # when mix-encode, use r-net methods, that concat char-encoding and word-embedding to represent sequence
         self.mix_encode = global_config['model']['encoder']['mix_encode']
+        self.joint_encode = global_config['model']['encoder']['joint_encode']
         encoder_bidirection = global_config['model']['encoder']['bidirection']
         encoder_direction_num = 2 if encoder_bidirection else 1
 
@@ -57,6 +60,7 @@ class MatchLSTMModel(torch.nn.Module):
         self.enable_birnn_after_self = global_config['model']['interaction']['birnn_after_self']
         gated_attention = global_config['model']['interaction']['gated_attention']
         mlp_attention = global_config['model']['interaction']['mlp_attention']
+        match_checkpoint_steps = global_config['model']['interaction']['checkpoint_steps']
 
         match_lstm_direction_num = 2 if match_lstm_bidirection else 1
         self_match_lstm_direction_num = 2 if self_match_lstm_bidirection else 1
@@ -65,15 +69,29 @@ class MatchLSTMModel(torch.nn.Module):
         ptr_direction_num = 2 if ptr_bidirection else 1
         self.init_ptr_hidden_mode = global_config['model']['output']['init_ptr_hidden']
         self.enable_search = global_config['model']['output']['answer_search']
+        self.log_space = global_config['model']['output']['log_space']
+
+        # eval-mode prediction on overlapping windows of long context
+        self.window_size = global_config['data']['window_size']
+        self.window_stride = global_config['data']['window_stride']
+        if self.window_size > 0 and not 0 < self.window_stride <= self.window_size:
+            raise ValueError('window_stride should be in (0, window_size], but got %d' % self.window_stride)
+
+        # set by train or test config, see `bf16_autocast`
+        self.enable_autocast = False
 
         # construct model
-        self.embedding = GloveEmbedding(dataset_h5_path=global_config['data']['dataset_h5'])
+        self.embedding = GloveEmbedding(dataset_h5_path=global_config['data']['dataset_h5'],
+                                        mmap_path=global_config['data']['embedding_mmap_path'],
+                                        storage=global_config['data']['embedding_storage'])
         encode_in_size = word_embedding_size
 
         if self.enable_char:
             self.char_embedding = CharEmbedding(dataset_h5_path=global_config['data']['dataset_h5'],
                                                 embedding_size=char_embedding_size,
                                                 trainable=char_trainable)
+            # char-level lstm encodes each word on its chars only, cnn does when char_width_invariant
+            self.char_width_invariant = char_type == 'LSTM' or char_width_invariant
             if char_type == 'LSTM':
                 self.char_encoder = CharEncoder(mode=hidden_mode,
                                                 input_size=char_embedding_size,
@@ -86,9 +104,16 @@ class MatchLSTMModel(torch.nn.Module):
                                                    hidden_size=word_embedding_size,
                                                    filters_size=char_cnn_filter_size,
                                                    filters_num=char_cnn_filter_num,
-                                                   dropout_p=dropout_p)
+                                                   dropout_p=dropout_p,
+                                                   width_invariant=char_width_invariant)
             else:
                 raise ValueError('Unrecognized char_encode_type of value %s' % char_type)
+
+            # only used when predicting
+            if char_cache_size > 0 and not self.char_width_invariant:
+                raise ValueError('char_cache_size > 0 needs char_width_invariant with cnn char encoder, '
+                                 'that cached encodings not depend on the char width of batch')
+            self.char_cache = CharEncodingCache(char_cache_size) if char_cache_size > 0 else None
             if self.mix_encode:
                 encode_in_size += hidden_size * encoder_direction_num
 
@@ -108,7 +133,8 @@ class MatchLSTMModel(torch.nn.Module):
                                   bidirectional=match_lstm_bidirection,
                                   gated_attention=gated_attention,
                                   mlp_attention=mlp_attention,
-                                  dropout_p=dropout_p)
+                                  dropout_p=dropout_p,
+                                  checkpoint_steps=match_checkpoint_steps)
         match_lstm_out_size = hidden_size * match_lstm_direction_num
 
         if self.enable_self_match:
@@ -118,7 +144,8 @@ class MatchLSTMModel(torch.nn.Module):
                                            bidirectional=self_match_lstm_bidirection,
                                            gated_attention=gated_attention,
                                            mlp_attention=mlp_attention,
-                                           dropout_p=dropout_p)
+                                           dropout_p=dropout_p,
+                                           checkpoint_steps=match_checkpoint_steps)
             match_lstm_out_size = hidden_size * self_match_lstm_direction_num
 
         if self.enable_birnn_after_self:
@@ -134,7 +161,8 @@ class MatchLSTMModel(torch.nn.Module):
                                            input_size=match_lstm_out_size,
                                            hidden_size=hidden_size,
                                            bidirectional=ptr_bidirection,
-                                           dropout_p=dropout_p)
+                                           dropout_p=dropout_p,
+                                           log_space=self.log_space)
         ptr_in_size = hidden_size * ptr_direction_num
 
         # pointer net init hidden generate
@@ -152,17 +180,198 @@ class MatchLSTMModel(torch.nn.Module):
         if self.enable_char:
             assert context_char is not None and question_char is not None
 
+        if self.is_windowed(context):
+            return self.forward_windows(context, question, context_char, question_char)
+        return self.forward_context(context, question, context_char, question_char)
+
+    def forward_context(self, context, question, context_char=None, question_char=None):
+        """
+        predict on the whole context
+        """
+        ans_range_prop, context_mask, vis_param = self.forward_range_prop(context, question, context_char,
+                                                                          question_char)
+
+        # answer range
+        if self.enable_search:
+            ans_range = answer_search(ans_range_prop, context_mask, log_space=self.log_space)
+        else:
+            ans_range = torch.max(ans_range_prop, 2)[1]
+
+        return ans_range_prop, ans_range, vis_param
+
+    def forward_range_prop(self, context, question, context_char=None, question_char=None):
+        """
+        answer range probability on the whole context, without searching the answer
+        :return: ans_range_prop (batch, 2, context_len), context_mask (batch, context_len), vis_param
+        """
+        # bf16 autocast on encoder, match and pointer layers, note that softmax inside keeps float32
+        with torch.autocast(device_type=context.device.type, dtype=torch.bfloat16, enabled=self.enable_autocast):
+            # encode: (seq_len, batch, hidden_size)
+            if self.joint_encode:
+                context_encode, context_mask, question_encode, question_mask = self.encode_joint(context, question,
+                                                                                                  context_char,
+                                                                                                  question_char)
+            else:
+                context_encode, context_mask, question_encode, question_mask = self.encode(context, question,
+                                                                                            context_char, question_char)
+
+            # match lstm: (seq_len, batch, hidden_size)
+            qt_aware_ct, qt_aware_last_hidden, match_alpha = self.match_rnn.forward(context_encode, context_mask,
+                                                                                    question_encode, question_mask)
+            vis_param = {'match': match_alpha}
+
+            # self match lstm: (seq_len, batch, hidden_size)
+            if self.enable_self_match:
+                qt_aware_ct, qt_aware_last_hidden, self_alpha = self.self_match_rnn.forward(qt_aware_ct,
+                                                                                            context_mask,
+                                                                                            qt_aware_ct,
+                                                                                            context_mask)
+                vis_param['self'] = self_alpha
+
+            # birnn after self match: (seq_len, batch, hidden_size)
+            if self.enable_birnn_after_self:
+                qt_aware_ct, _ = self.birnn_after_self.forward(qt_aware_ct, context_mask)
+
+            # pointer net init hidden: (batch, hidden_size)
+            ptr_net_hidden = None
+            if self.init_ptr_hidden_mode == 'pooling':
+                ptr_net_hidden = self.init_ptr_hidden.forward(question_encode, question_mask)
+            elif self.init_ptr_hidden_mode == 'linear':
+                ptr_net_hidden = self.init_ptr_hidden.forward(qt_aware_last_hidden)
+                ptr_net_hidden = F.tanh(ptr_net_hidden)
+
+            # pointer net: (answer_len, batch, context_len)
+            ans_range_prop = self.pointer_net.forward(qt_aware_ct, context_mask, ptr_net_hidden)
+        ans_range_prop = ans_range_prop.float().transpose(0, 1)
+
+        return ans_range_prop, context_mask, vis_param
+
+    def predict_nbest(self, context, question, context_char=None, question_char=None, k=5):
+        """
+        predict the k best answers of each sample, searched on the answer range probability in batch
+        :param k: count of answers
+        :return: ans_range (batch, k, 2), ans_score (batch, k) with probability of each answer
+        """
+        if self.is_windowed(context):
+            ans_range, ans_score = self.predict_nbest_windows(context, question, context_char, question_char, k)
+        else:
+            ans_range_prop, context_mask, _ = self.forward_range_prop(context, question, context_char, question_char)
+            ans_range, ans_score = answer_search(ans_range_prop, context_mask, top_k=k, log_space=self.log_space)
+
+        # back to probability, and keep -inf of the invalid answers
+        if self.log_space:
+            ans_score = torch.where(torch.isinf(ans_score), ans_score, ans_score.exp())
+        return ans_range, ans_score
+
+    def is_windowed(self, context):
+        """
+        whether predict on windows, only on eval mode that train samples are windowed when preprocessing
+        """
+        return not self.training and 0 < self.window_size < context.shape[1]
+
+    def split_windows(self, context, question, context_char=None, question_char=None):
+        """
+        split every context to overlapping windows of window_size, with question repeated on each window
+        :return: (context, question, context_char, question_char) of windows,
+                 window_sample (windows_num,) the sample index of each window,
+                 window_start (windows_num,) the start position in the context of each window
+        """
+        lengths = compute_mask(context, PreprocessData.padding_idx).sum(1).long().tolist()
+        window_sample = []
+        window_start = []
+        for i, length in enumerate(lengths):
+            for start in window_starts(length, self.window_size, self.window_stride):
+                window_sample.append(i)
+                window_start.append(start)
+        window_sample = torch.tensor(window_sample, dtype=torch.long, device=context.device)
+        window_start = torch.tensor(window_start, dtype=torch.long, device=context.device)
+
+        # window of short context is filled with its padding: (windows_num, window_size)
+        positions = window_start.unsqueeze(1) + torch.arange(self.window_size, device=context.device).unsqueeze(0)
+        window_batch = [context[window_sample.unsqueeze(1), positions],
+                        question.index_select(0, window_sample),
+                        None, None]
+        if context_char is not None:
+            window_batch[2] = context_char[window_sample.unsqueeze(1), positions]
+            window_batch[3] = question_char.index_select(0, window_sample)
+
+        return window_batch, window_sample, window_start
+
+    def forward_windows(self, context, question, context_char=None, question_char=None):
+        """
+        predict on windows of long context, the answer of the best scored window is selected,
+        and the answer range probability is the max of windows on each position
+        :return: ans_range_prop (batch, 2, context_len), ans_range (batch, 2), empty vis_param
+        """
+        window_batch, window_sample, window_start = self.split_windows(context, question, context_char, question_char)
+        window_prop, window_mask, _ = self.forward_range_prop(*window_batch)
+
+        if self.enable_search:
+            window_range, window_score = answer_search(window_prop, window_mask, top_k=1, log_space=self.log_space)
+            window_range, window_score = window_range[:, 0], window_score[:, 0]
+        else:
+            window_score, window_range = torch.max(window_prop, 2)
+            window_score = window_score.sum(1) if self.log_space else window_score.prod(1)
+
+        # the first window with the best score of each sample
+        batch_size, context_len = context.shape
+        windows_num = window_sample.shape[0]
+        best_score = window_score.new_full((batch_size,), float('-inf')) \
+            .scatter_reduce(0, window_sample, window_score, reduce='amax')
+        window_idx = torch.arange(windows_num, device=context.device)
+        window_idx = window_idx.masked_fill(window_score.ne(best_score[window_sample]), windows_num)
+        best_window = window_idx.new_full((batch_size,), windows_num) \
+            .scatter_reduce(0, window_sample, window_idx, reduce='amin')
+        ans_range = window_range[best_window] + window_start[best_window].unsqueeze(1)
+
+        # max of windows on each position: (batch, 2, context_len)
+        positions = window_start.unsqueeze(1) + torch.arange(self.window_size, device=context.device).unsqueeze(0)
+        positions = (window_sample.unsqueeze(1) * context_len + positions).view(1, -1).expand(2, -1)
+        ans_range_prop = window_prop.new_full((2, batch_size * context_len), float('-inf') if self.log_space else 0.) \
+            .scatter_reduce(1, positions, window_prop.transpose(0, 1).reshape(2, -1), reduce='amax')
+        ans_range_prop = ans_range_prop.view(2, batch_size, context_len).transpose(0, 1)
+
+        return ans_range_prop, ans_range, {}
+
+    def predict_nbest_windows(self, context, question, context_char=None, question_char=None, k=5):
+        """
+        k best answers on windows of long context, the same answer of overlapped windows keeps the best score
+        :return: ans_range (batch, k, 2), ans_score (batch, k) with the score of answer_search
+        """
+        window_batch, window_sample, window_start = self.split_windows(context, question, context_char, question_char)
+        window_prop, window_mask, _ = self.forward_range_prop(*window_batch)
+        window_range, window_score = answer_search(window_prop, window_mask, top_k=k, log_space=self.log_space)
+        window_range = window_range + window_start.view(-1, 1, 1)
+
+        candidates = [{} for _ in range(context.shape[0])]
+        for i, a_lst, s_lst in zip(window_sample.tolist(), window_range.tolist(), window_score.tolist()):
+            for a, s in zip(a_lst, s_lst):
+                if s == float('-inf'):    # short window has less answers
+                    continue
+                candidates[i][tuple(a)] = max(s, candidates[i].get(tuple(a), float('-inf')))
+
+        ans_range = window_range.new_zeros((context.shape[0], k, 2))
+        ans_score = window_score.new_full((context.shape[0], k), float('-inf'))
+        for i, c in enumerate(candidates):
+            best = sorted(c.items(), key=lambda x: x[1], reverse=True)[:k]
+            if best:
+                ans_range[i, :len(best)] = torch.tensor([a for a, _ in best], dtype=ans_range.dtype)
+                ans_score[i, :len(best)] = torch.tensor([s for _, s in best], dtype=ans_score.dtype)
+
+        return ans_range, ans_score
+
+    def encode(self, context, question, context_char=None, question_char=None):
+        """
+        encode context and question separately
+        :return: context_encode, context_mask, question_encode, question_mask
+        """
         # get embedding: (seq_len, batch, embedding_size)
         context_vec, context_mask = self.embedding.forward(context)
         question_vec, question_mask = self.embedding.forward(question)
 
         # char-level embedding: (seq_len, batch, char_embedding_size)
         if self.enable_char:
-            context_emb_char, context_char_mask = self.char_embedding.forward(context_char)
-            question_emb_char, question_char_mask = self.char_embedding.forward(question_char)
-
-            context_vec_char = self.char_encoder.forward(context_emb_char, context_char_mask, context_mask)
-            question_vec_char = self.char_encoder.forward(question_emb_char, question_char_mask, question_mask)
+            context_vec_char, question_vec_char = self.char_encode([context, question], [context_char, question_char])
 
             if self.mix_encode:
                 context_vec = torch.cat((context_vec, context_vec_char), dim=-1)
@@ -177,37 +386,146 @@ class MatchLSTMModel(torch.nn.Module):
             context_encode = torch.cat((context_encode, context_vec_char), dim=-1)
             question_encode = torch.cat((question_encode, question_vec_char), dim=-1)
 
-        # match lstm: (seq_len, batch, hidden_size)
-        qt_aware_ct, qt_aware_last_hidden, match_alpha = self.match_rnn.forward(context_encode, context_mask,
-                                                                                question_encode, question_mask)
-        vis_param = {'match': match_alpha}
+        return context_encode, context_mask, question_encode, question_mask
 
-        # self match lstm: (seq_len, batch, hidden_size)
-        if self.enable_self_match:
-            qt_aware_ct, qt_aware_last_hidden, self_alpha = self.self_match_rnn.forward(qt_aware_ct, context_mask,
-                                                                                        qt_aware_ct, context_mask)
-            vis_param['self'] = self_alpha
+    def encode_joint(self, context, question, context_char=None, question_char=None):
+        """
+        encode context and question in one call of each module, by concatenating them on batch dim
+        :return: context_encode, context_mask, question_encode, question_mask
+        """
+        batch_size = context.shape[0]
+        context_len = context.shape[1]
+        question_len = question.shape[1]
+        seq_len = max(context_len, question_len)
 
-        # birnn after self match: (seq_len, batch, hidden_size)
-        if self.enable_birnn_after_self:
-            qt_aware_ct, _ = self.birnn_after_self.forward(qt_aware_ct, context_mask)
+        # get embedding: (seq_len, batch*2, embedding_size)
+        words = torch.cat((F.pad(context, (0, seq_len - context_len)),
+                           F.pad(question, (0, seq_len - question_len))), dim=0)
+        words_vec, words_mask = self.embedding.forward(words)
 
-        # pointer net init hidden: (batch, hidden_size)
-        ptr_net_hidden = None
-        if self.init_ptr_hidden_mode == 'pooling':
-            ptr_net_hidden = self.init_ptr_hidden.forward(question_encode, question_mask)
-        elif self.init_ptr_hidden_mode == 'linear':
-            ptr_net_hidden = self.init_ptr_hidden.forward(qt_aware_last_hidden)
-            ptr_net_hidden = F.tanh(ptr_net_hidden)
+        # char-level embedding: (seq_len, batch*2, char_embedding_size)
+        if self.enable_char:
+            context_vec_char, question_vec_char = self.char_encode([context, question], [context_char, question_char])
+            words_vec_char = torch.cat((F.pad(context_vec_char, (0, 0, 0, 0, 0, seq_len - context_len)),
+                                        F.pad(question_vec_char, (0, 0, 0, 0, 0, seq_len - question_len))), dim=1)
+
+            if self.mix_encode:
+                words_vec = torch.cat((words_vec, words_vec_char), dim=-1)
 
-        # pointer net: (answer_len, batch, context_len)
-        ans_range_prop = self.pointer_net.forward(qt_aware_ct, context_mask, ptr_net_hidden)
-        ans_range_prop = ans_range_prop.transpose(0, 1)
+        # encode: (seq_len, batch*2, hidden_size)
+        words_encode, _ = self.encoder.forward(words_vec, words_mask)
 
-        # answer range
-        if self.enable_search:
-            ans_range = answer_search(ans_range_prop, context_mask)
+        # char-level encode: (seq_len, batch*2, hidden_size)
+        if self.enable_char and not self.mix_encode:
+            words_encode = torch.cat((words_encode, words_vec_char), dim=-1)
+
+        context_encode = words_encode[:context_len, :batch_size]
+        question_encode = words_encode[:question_len, batch_size:]
+        context_mask = words_mask[:batch_size, :context_len]
+        question_mask = words_mask[batch_size:, :question_len]
+
+        return context_encode, context_mask, question_encode, question_mask
+
+    def char_encode(self, words, words_char):
+        """
+        char-level encode sequences, where every distinct word id in all sequences only encoded once.
+        Without char_width_invariant, the encodings depend on the padded char width, so that distinct words are
+        encoded in each sequence separately, on the same char width as the sequence batch.
+        Note that when training, the dropout inside char embedding and char encoder is also drawn once for each
+        distinct word, so all occurrences of a word in the batch share the same dropout mask
+        :param words: list of (batch, seq_len) with word index
+        :param words_char: list of (batch, seq_len, word_len) with char index
+        :return: list of (seq_len, batch, hidden_size)
+        """
+        if not self.char_width_invariant and len(words) > 1:
+            return [self.char_encode([x], [x_char])[0] for x, x_char in zip(words, words_char)]
+
+        word_len = max(map(lambda x: x.shape[2], words_char))
+        flat_words = torch.cat([x.contiguous().view(-1) for x in words])
+        flat_char = torch.cat([F.pad(x, (0, word_len - x.shape[2])).view(-1, word_len) for x in words_char], dim=0)
+
+        # the same word id always has the same chars, so any position of it can be picked
+        uniq_words, uniq_inverse = torch.unique(flat_words, return_inverse=True)
+        flat_pos = torch.arange(flat_words.shape[0], dtype=torch.long, device=flat_words.device)
+        uniq_pos = uniq_inverse.new_empty(uniq_words.shape[0]).scatter_(0, uniq_inverse, flat_pos)
+        uniq_char = flat_char.index_select(0, uniq_pos)  # (word_num, word_len)
+
+        if self.char_cache is not None and not self.training:
+            uniq_vec = self.char_encode_cached(uniq_words, uniq_char)
         else:
-            ans_range = torch.max(ans_range_prop, 2)[1]
-
-        return ans_range_prop, ans_range, vis_param
+            uniq_vec = self.char_encode_words(uniq_words, uniq_char)
+
+        # scatter back to each sequence position
+        flat_vec = uniq_vec.index_select(0, uniq_inverse)
+        rtn_vec = []
+        offset = 0
+        for x in words:
+            x_size = x.numel()
+            x_vec = flat_vec[offset:(offset + x_size)].view(x.shape[0], x.shape[1], -1)
+            rtn_vec.append(x_vec.transpose(0, 1))
+            offset += x_size
+
+        return rtn_vec
+
+    def char_encode_words(self, words, words_char):
+        """
+        char-level encode words as one sequence
+        :param words: (word_num,) with word index
+        :param words_char: (word_num, word_len) with char index
+        :return: (word_num, hidden_size)
+        """
+        word_len = compute_mask(words_char, 0).sum(1).max().long().item()
+        words_char = words_char[:, :word_len]
+
+        # padding word keep the same mask with each sequence
+        words_mask = compute_mask(words, PreprocessData.padding_idx).unsqueeze(0)  # (1, word_num)
+        words_emb, words_char_mask = self.char_embedding.forward(words_char.unsqueeze(0))
+        words_vec = self.char_encoder.forward(words_emb, words_char_mask, words_mask).squeeze(1)
+
+        return words_vec
+
+    def char_encode_cached(self, words, words_char):
+        """
+        char-level encode words with the lru cache, only encode words not in cache
+        :param words: (word_num,) with word index
+        :param words_char: (word_num, word_len) with char index
+        :return: (word_num, hidden_size)
+        """
+        self.char_cache.check_weight(list(self.char_embedding.parameters()) + list(self.char_encoder.parameters()))
+
+        hit_idx = []
+        hit_vec = []
+        miss_idx = []
+        for i, w in enumerate(words.tolist()):
+            cur_vec = self.char_cache.get(w)
+            if cur_vec is None:
+                miss_idx.append(i)
+            else:
+                hit_idx.append(i)
+                hit_vec.append(cur_vec)
+
+        if len(miss_idx) == 0:
+            return torch.stack(hit_vec, dim=0)
+
+        miss_idx = words.new_tensor(miss_idx)
+        miss_words = words.index_select(0, miss_idx)
+        miss_vec = self.char_encode_words(miss_words, words_char.index_select(0, miss_idx)).detach()
+        for w, v in zip(miss_words.tolist(), miss_vec):
+            self.char_cache.put(w, v)
+
+        if len(hit_idx) == 0:
+            return miss_vec
+
+        words_vec = miss_vec.new_empty(words.shape[0], miss_vec.shape[1])
+        words_vec[miss_idx] = miss_vec
+        words_vec[words.new_tensor(hit_idx)] = torch.stack(hit_vec, dim=0)
+        return words_vec
+
+    def char_cache_stats(self):
+        """
+        hit-rate statistics of char-level encoding cache
+        :return: dict or None if cache not enabled
+        """
+        if not self.enable_char or self.char_cache is None:
+            return None
+        return self.char_cache.stats()
@@ -8,20 +8,33 @@ import os
 import torch
 import logging
 import argparse
+import multiprocessing
 from dataset.squad_dataset import SquadDataset
 from models.match_lstm import MatchLSTMModel
 from utils.load_config import init_logging, read_config
 from models.loss import MyNLLLoss
 from utils.eval import eval_on_model
+from utils.functions import quantize_dynamic_model, set_torch_threads
 
 init_logging()
 logger = logging.getLogger(__name__)
 
+# function and batches of sharded prediction, set before forking workers that read them with copy-on-write pages
+shard_state = {}
 
-def main(config_path, out_path):
+
+def main(config_path, out_path, nbest=None, overlay_paths=None):
     logger.info('------------Match-LSTM Evaluate--------------')
     logger.info('loading config file...')
-    global_config = read_config(config_path)
+    global_config = read_config(config_path, overlay_paths)
+
+    # no parallel work before forking the sharded workers, that gnu openmp threads are not usable after fork
+    num_workers = global_config['test']['num_workers']
+    worker_threads = global_config['test']['worker_threads']
+    if num_workers > 1:
+        set_torch_threads(1, 0)
+    else:
+        set_torch_threads(global_config['test']['num_threads'], global_config['test']['num_interop_threads'])
 
     # set random seed
     seed = global_config['model']['global']['random_seed']
@@ -33,6 +46,8 @@ def main(config_path, out_path):
         logger.warning("CUDA is avaliable, you can enable CUDA in config file")
     elif not torch.cuda.is_available() and enable_cuda:
         raise ValueError("CUDA is not abaliable, please unable CUDA in config file")
+    if enable_cuda and num_workers > 1:
+        raise ValueError("sharded prediction only support cpu, please set num_workers to 1 in config file")
 
     torch.no_grad()  # make sure all tensors below have require_grad=False
 
@@ -41,6 +56,7 @@ def main(config_path, out_path):
 
     logger.info('constructing model...')
     model = MatchLSTMModel(global_config).to(device)
+    model.enable_autocast = global_config['test']['bf16_autocast']
     model.eval()  # let training = False, make sure right dropout
 
     # load model weight
@@ -53,6 +69,19 @@ def main(config_path, out_path):
         weight = torch.load(model_weight_path, map_location=lambda storage, loc: storage.cuda())
     model.load_state_dict(weight, strict=False)
 
+    # int8 dynamic quantization
+    if global_config['test']['quantize']:
+        if enable_cuda:
+            raise ValueError("quantized model only support cpu, please unable CUDA in config file")
+        logger.info('quantizing model...')
+        model = quantize_dynamic_model(model)
+
+    # shards would fill their own char cache from different batches, that encodings differ on float rounding,
+    # so the char cache is not used on shards to keep the same results for any num_workers
+    if num_workers > 1 and model.enable_char and model.char_cache is not None:
+        logger.info('char cache disabled on %d workers' % num_workers)
+        model.char_cache = None
+
     # forward
     logger.info('forwarding...')
 
@@ -63,22 +92,65 @@ def main(config_path, out_path):
 
     # to just evaluate score or write answer to file
     if out_path is None:
-        criterion = MyNLLLoss()
-        score_em, score_f1, sum_loss = eval_on_model(model=model,
-                                                     criterion=criterion,
-                                                     batch_data=batch_dev_data,
-                                                     epoch=None,
-                                                     device=device,
-                                                     enable_char=enable_char,
-                                                     batch_char_func=dataset.gen_batch_with_char)
+        criterion = MyNLLLoss(multi_span=global_config['model']['output']['multi_span'],
+                          log_space=global_config['model']['output']['log_space'])
+
+        def eval_batches(batch_data, shard_idx, samples_offset):
+            scores = eval_on_model(model=model,
+                                   criterion=criterion,
+                                   batch_data=batch_data,
+                                   epoch=None,
+                                   device=device,
+                                   enable_char=enable_char,
+                                   batch_char_func=dataset.gen_batch_with_char)
+
+            char_cache_stats = model.char_cache_stats()
+            if char_cache_stats is not None:
+                logger.info('shard=%d, char cache: size=%d/%d, hits=%d, misses=%d, evictions=%d, hit_rate=%.4f' %
+                            (shard_idx, char_cache_stats['size'], char_cache_stats['max_size'],
+                             char_cache_stats['hits'], char_cache_stats['misses'], char_cache_stats['evictions'],
+                             char_cache_stats['hit_rate']))
+            return scores, sum(map(lambda x: x[0].shape[0], batch_data))
+
+        shard_scores = run_batches(eval_batches, batch_dev_data, num_workers, worker_threads)
+        score_em, score_f1, sum_loss = merge_scores(shard_scores)
         logger.info("test: ave_score_em=%.2f, ave_score_f1=%.2f, sum_loss=%.5f" % (score_em, score_f1, sum_loss))
-    else:
-        predict_ans = predict_on_model(model=model,
-                                       batch_data=batch_dev_data,
+    elif nbest is not None:
+        samples_id = dataset.get_all_samples_id_dev()
+
+        # every shard writes its part file, joined on the order of shards
+        def predict_nbest_batches(batch_data, shard_idx, samples_offset):
+            part_path = out_path if num_workers <= 1 else '%s.part%d' % (out_path, shard_idx)
+            with open(part_path, 'w') as f:
+                predict_nbest_on_model(model=model,
+                                       batch_data=batch_data,
                                        device=device,
                                        enable_char=enable_char,
                                        batch_char_func=dataset.gen_batch_with_char,
-                                       id_to_word_func=dataset.sentence_id2word)
+                                       id_to_word_func=dataset.sentence_id2word,
+                                       samples_id=samples_id[samples_offset:],
+                                       k=nbest,
+                                       out_file=f)
+            return part_path
+
+        logging.info('writing %d best answers to file %s' % (nbest, out_path))
+        part_paths = run_batches(predict_nbest_batches, batch_dev_data, num_workers, worker_threads)
+        if num_workers > 1:
+            with open(out_path, 'w') as f:
+                for part_path in part_paths:
+                    with open(part_path, 'r') as f_part:
+                        f.write(f_part.read())
+                    os.remove(part_path)
+    else:
+        def predict_batches(batch_data, shard_idx, samples_offset):
+            return predict_on_model(model=model,
+                                    batch_data=batch_data,
+                                    device=device,
+                                    enable_char=enable_char,
+                                    batch_char_func=dataset.gen_batch_with_char,
+                                    id_to_word_func=dataset.sentence_id2word)
+
+        predict_ans = sum(run_batches(predict_batches, batch_dev_data, num_workers, worker_threads), [])
         samples_id = dataset.get_all_samples_id_dev()
         ans_with_id = dict(zip(samples_id, predict_ans))
 
@@ -89,6 +161,64 @@ def main(config_path, out_path):
     logging.info('finished.')
 
 
+def run_batches(func, batch_data, num_workers, worker_threads):
+    """
+    call func(batch_data, shard_idx, samples_offset) on this process, or on forked workers with a contiguous shard
+    of batches each when num_workers > 1. the model and dataset are shared with workers by copy-on-write pages
+    :param func:
+    :param batch_data: list of batches
+    :param num_workers:
+    :param worker_threads: intra-op threads of each worker
+    :return: list of func results on the order of shards
+    """
+    if num_workers <= 1:
+        return [func(batch_data, 0, 0)]
+
+    # shards differ by one batch at most
+    num_workers = min(num_workers, len(batch_data))
+    shard_size, shard_remain = divmod(len(batch_data), num_workers)
+    shards = []
+    offsets = []
+    start = 0
+    samples_offset = 0
+    for i in range(num_workers):
+        end = start + shard_size + (1 if i < shard_remain else 0)
+        shards.append(batch_data[start:end])
+        offsets.append(samples_offset)
+        samples_offset += sum(map(lambda x: x[0].shape[0], shards[-1]))
+        start = end
+
+    logger.info('predicting %d batches on %d workers...' % (len(batch_data), num_workers))
+    shard_state.update(func=func, shards=shards, offsets=offsets, threads=worker_threads)
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(num_workers) as pool:
+        results = pool.map(run_shard, range(num_workers), chunksize=1)
+    shard_state.clear()
+    return results
+
+
+def run_shard(shard_idx):
+    torch.set_num_threads(shard_state['threads'])
+    with torch.no_grad():
+        return shard_state['func'](shard_state['shards'][shard_idx], shard_idx, shard_state['offsets'][shard_idx])
+
+
+def merge_scores(shard_scores):
+    """
+    average em and f1 of shards weighted by their size, and sum the loss
+    :param shard_scores: list of ((em, f1, sum_loss), size)
+    :return: (em, f1, sum_loss)
+    """
+    if len(shard_scores) == 1:
+        return shard_scores[0][0]
+
+    data_size = sum(map(lambda x: x[1], shard_scores))
+    score_em = sum(map(lambda x: round(x[0][0] * x[1]), shard_scores)) * 1. / data_size
+    score_f1 = sum(map(lambda x: x[0][1] * x[1], shard_scores)) / data_size
+    sum_loss = sum(map(lambda x: x[0][2], shard_scores))
+    return score_em, score_f1, sum_loss
+
+
 def predict_on_model(model, batch_data, device, enable_char, batch_char_func, id_to_word_func):
     batch_cnt = len(batch_data)
     answer = []
@@ -115,10 +245,54 @@ def predict_on_model(model, batch_data, device, enable_char, batch_char_func, id
     return answer
 
 
+def predict_nbest_on_model(model, batch_data, device, enable_char, batch_char_func, id_to_word_func, samples_id, k,
+                           out_file):
+    """
+    predict k best answers on every batch, and stream to file with one json line of each sample
+    :param samples_id: samples id with the same order of batch data
+    :param k: count of answers on each sample
+    :param out_file: file object to write
+    :return:
+    """
+    batch_cnt = len(batch_data)
+    samples_idx = 0
+
+    for bnum, batch in enumerate(batch_data):
+
+        # batch data
+        bat_context, bat_question, bat_context_char, bat_question_char, bat_answer_range = \
+            batch_char_func(batch, enable_char=enable_char, device=device)
+
+        tmp_ans_range, tmp_ans_score = model.predict_nbest(bat_context, bat_question, bat_context_char,
+                                                           bat_question_char, k=k)
+        tmp_context_ans = zip(bat_context.cpu().data.numpy(),
+                              tmp_ans_range.cpu().data.numpy(),
+                              tmp_ans_score.cpu().data.numpy())
+        for c, a_lst, s_lst in tmp_context_ans:
+            nbest = [{'start': int(a[0]),
+                      'end': int(a[1]),
+                      'score': float(s),
+                      'text': ' '.join(id_to_word_func(c[a[0]:(a[1] + 1)]))}
+                     for a, s in zip(a_lst, s_lst) if s > float('-inf')]  # short context has less answers
+            out_file.write(json.dumps({'id': samples_id[samples_idx], 'nbest': nbest}) + '\n')
+            samples_idx += 1
+
+        logging.info('batch=%d/%d' % (bnum, batch_cnt))
+
+        # manual release memory, todo: really effect?
+        del bat_context, bat_question, bat_answer_range, bat_context_char, bat_question_char
+        del tmp_ans_range, tmp_ans_score
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="evaluate on the model")
     parser.add_argument('--config', '-c', required=False, dest='config_path', default='config/model_config.yaml')
     parser.add_argument('--output', '-o', required=False, dest='out_path')
+    parser.add_argument('--nbest', '-k', required=False, dest='nbest', type=int, default=None)
+    parser.add_argument('--overlay', required=False, nargs='+', dest='overlay_paths', default=None,
+                        help='config files override part of config, such as output of helper_run/autotune.py')
     args = parser.parse_args()
+    if args.nbest is not None and args.out_path is None:
+        parser.error('--nbest needs --output to write the answers')
 
-    main(config_path=args.config_path, out_path=args.out_path)
+    main(config_path=args.config_path, out_path=args.out_path, nbest=args.nbest, overlay_paths=args.overlay_paths)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import pytest
+from utils.functions import answer_search
+
+
+def gen_prop(lengths, context_len, log_space):
+    """
+    random start and end probability with padding masked
+    :return: answer_prop (batch, 2, context_len), mask (batch, context_len)
+    """
+    mask = (torch.arange(context_len).unsqueeze(0) < torch.tensor(lengths).unsqueeze(1)).float()
+    logits = torch.randn(len(lengths), 2, context_len).masked_fill(mask.unsqueeze(1).eq(0), float('-inf'))
+    prop = torch.log_softmax(logits, dim=2) if log_space else torch.softmax(logits, dim=2)
+    return prop, mask
+
+
+def brute_force_search(answer_prop, lengths, max_tokens, log_space):
+    """
+    score of every answer no more than max_tokens in each context
+    :return: list of sorted [(score, (start, end))] of each sample
+    """
+    rtn = []
+    for prop, length in zip(answer_prop.tolist(), lengths):
+        answers = []
+        for s in range(length):
+            for e in range(s, min(s + max_tokens, length)):
+                p_s = torch.tensor(prop[0][s])
+                p_e = torch.tensor(prop[1][e])
+                answers.append(((p_s + p_e if log_space else p_s * p_e).item(), (s, e)))
+        rtn.append(sorted(answers, key=lambda x: x[0], reverse=True))
+    return rtn
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+@pytest.mark.parametrize('max_tokens', [1, 4, 15])
+def test_best_answer(log_space, max_tokens):
+    torch.manual_seed(0)
+    lengths = [12, 1, 7, 3, 12]
+    answer_prop, mask = gen_prop(lengths, 12, log_space)
+
+    ans_range = answer_search(answer_prop, mask, max_tokens=max_tokens, log_space=log_space)
+    expect = brute_force_search(answer_prop, lengths, max_tokens, log_space)
+    assert ans_range.tolist() == [list(x[0][1]) for x in expect]
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+def test_top_k_answers(log_space):
+    torch.manual_seed(1)
+    lengths = [10, 2, 6, 10]
+    k = 5
+    answer_prop, mask = gen_prop(lengths, 10, log_space)
+
+    ans_range, ans_score = answer_search(answer_prop, mask, max_tokens=3, top_k=k, log_space=log_space)
+    expect = brute_force_search(answer_prop, lengths, 3, log_space)
+    assert ans_range.shape == (len(lengths), k, 2)
+
+    # short context has less answers, with -inf scores after them
+    for a_lst, s_lst, e_lst in zip(ans_range.tolist(), ans_score.tolist(), expect):
+        n = min(k, len(e_lst))
+        assert s_lst[:n] == [x[0] for x in e_lst[:n]]
+        assert [tuple(a) for a in a_lst[:n]] == [x[1] for x in e_lst[:n]]
+        assert all(s == float('-inf') for s in s_lst[n:])
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import h5py
+import yaml
+import torch
+import numpy as np
+import pytest
+from models.match_lstm import MatchLSTMModel
+
+CHAR_DICT_SIZE = 30
+
+
+@pytest.fixture
+def global_config(tmp_path):
+    """
+    small model on a fake hdf5 file, that only has the glove table and char dict size
+    """
+    dataset_h5 = str(tmp_path / 'squad.h5')
+    with h5py.File(dataset_h5, 'w') as f:
+        f.attrs['char_dict_size'] = CHAR_DICT_SIZE
+        f.create_group('meta_data').create_dataset('id2vec', data=np.random.RandomState(0).rand(200, 8)
+                                                   .astype(np.float32))
+
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config/model_config.yaml')
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f.read())
+    config['data']['dataset_h5'] = dataset_h5
+    config['data']['embedding_mmap_path'] = None
+    config['model']['global']['hidden_size'] = 4
+    config['model']['encoder']['word_embedding_size'] = 8
+    config['model']['encoder']['char_embedding_size'] = 6
+    config['model']['encoder']['char_cnn_filter_num'] = [2, 2, 2, 2]
+    config['model']['encoder']['char_cache_size'] = 100
+    config['model']['encoder']['char_width_invariant'] = True
+    return config
+
+
+def gen_words_char(words, width):
+    """
+    (1, words_num) word index and (1, words_num, width) char index, the chars of a word only depend on its index
+    :param words: list of (word index, char length)
+    :param width: padded char width
+    """
+    words_char = torch.zeros(len(words), width, dtype=torch.long)
+    for i, (w, char_len) in enumerate(words):
+        g = torch.Generator().manual_seed(w)
+        words_char[i, :char_len] = torch.randint(1, CHAR_DICT_SIZE, (char_len,), generator=g)
+
+    return torch.tensor([w for w, _ in words]).view(1, -1), words_char.view(1, len(words), width)
+
+
+def char_encode(model, words, words_char):
+    with torch.no_grad():
+        return model.char_encode([words], [words_char])[0][:, 0]  # (words_num, hidden_size)
+
+
+@pytest.mark.parametrize('char_encode_type', ['CNN', 'LSTM'])
+def test_cached_same_as_uncached(global_config, char_encode_type):
+    global_config['model']['encoder']['char_encode_type'] = char_encode_type
+    torch.manual_seed(0)
+    model = MatchLSTMModel(global_config)
+    model.eval()
+
+    # words 5 and 11 in batches with different char width and size, also shorter than the widest filter
+    batch_a = gen_words_char([(5, 3), (7, 12), (9, 1), (11, 6)], 16)
+    batch_b = gen_words_char([(5, 3), (13, 2), (11, 6)], 6)
+    batch_c = gen_words_char([(5, 3), (15, 4)], 4)
+
+    char_cache = model.char_cache
+    model.char_cache = None
+    uncached = [char_encode(model, *x) for x in [batch_a, batch_b, batch_c]]
+
+    model.char_cache = char_cache
+    cached = [char_encode(model, *x) for x in [batch_a, batch_b, batch_c]]
+    assert model.char_cache_stats()['hits'] == 3
+
+    # only the float rounding of batched matmul differs between batch sizes
+    for u, c in zip(uncached, cached):
+        torch.testing.assert_close(c, u, rtol=0, atol=1e-6)
+    torch.testing.assert_close(uncached[1][0], uncached[0][0], rtol=0, atol=1e-6)
+    torch.testing.assert_close(uncached[1][2], uncached[0][3], rtol=0, atol=1e-6)
+    torch.testing.assert_close(uncached[2][0], uncached[0][0], rtol=0, atol=1e-6)
+
+
+def test_char_cnn_width_independent(global_config):
+    torch.manual_seed(0)
+    model = MatchLSTMModel(global_config)
+    model.eval()
+
+    words = [(5, 3), (7, 12), (9, 1), (11, 6)]
+    rtn = []
+    for width in [12, 16, 30]:
+        _, words_char = gen_words_char(words, width)
+        with torch.no_grad():
+            words_emb, words_char_mask = model.char_embedding.forward(words_char)
+            rtn.append(model.char_encoder.cnn.forward(words_emb, words_char_mask, torch.ones(1, len(words))))
+
+    assert torch.equal(rtn[0], rtn[1])
+    assert torch.equal(rtn[0], rtn[2])
+
+
+def test_char_cnn_default_max_pool(global_config):
+    """
+    without char_width_invariant, max-pool on all windows including the padded chars, as trained before
+    """
+    global_config['model']['encoder']['char_cache_size'] = 0
+    global_config['model']['encoder']['char_width_invariant'] = False
+    torch.manual_seed(0)
+    model = MatchLSTMModel(global_config)
+    model.eval()
+
+    _, words_char = gen_words_char([(5, 3), (7, 12), (9, 1), (11, 6)], 16)
+    with torch.no_grad():
+        words_emb, words_char_mask = model.char_embedding.forward(words_char)
+        rtn = model.char_encoder.cnn.forward(words_emb, words_char_mask, torch.ones(1, 4))
+
+        x = words_emb.view(-1, 16, words_emb.shape[-1]).unsqueeze(1)
+        expect = torch.cat([torch.max(torch.relu(cnn(x)).squeeze(-1), 2)[0] for cnn in model.char_encoder.cnn.cnns],
+                           dim=1)
+    assert torch.equal(rtn[:, 0], expect)
+
+
+def test_char_cache_needs_width_invariant(global_config):
+    global_config['model']['encoder']['char_width_invariant'] = False
+    with pytest.raises(ValueError):
+        MatchLSTMModel(global_config)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import h5py
+import numpy as np
+import pytest
+from models.layers import GloveEmbedding
+
+
+def write_h5(path, words_num, seed):
+    id2vec = np.random.RandomState(seed).rand(words_num, 8).astype(np.float32)
+    with h5py.File(path, 'w') as f:
+        f.attrs['word_dict_size'] = words_num
+        f.attrs['embedding_size'] = 8
+        f.create_group('meta_data').create_dataset('id2vec', data=id2vec)
+    return id2vec
+
+
+@pytest.mark.parametrize('storage', ['float32', 'float16'])
+def test_table_of_other_dataset_exported_again(tmp_path, storage):
+    mmap_path = str(tmp_path / 'glove.npy')
+    write_h5(str(tmp_path / 'a.h5'), 200, 0)
+    id2vec_b = write_h5(str(tmp_path / 'b.h5'), 50, 1)
+
+    # b.h5 is newer than the table of a.h5, but not the same dataset
+    GloveEmbedding(str(tmp_path / 'a.h5'), mmap_path=mmap_path, storage=storage)
+    os.utime(str(tmp_path / 'b.h5'), (0, 0))
+    embedding = GloveEmbedding(str(tmp_path / 'b.h5'), mmap_path=mmap_path, storage=storage)
+
+    weight = embedding.embedding_layer.weight.data.numpy()
+    assert weight.shape == (50, 8)
+    np.testing.assert_array_equal(weight, id2vec_b.astype(storage))
+
+
+def test_table_reused(tmp_path):
+    mmap_path = str(tmp_path / 'glove.npy')
+    write_h5(str(tmp_path / 'a.h5'), 20, 0)
+    GloveEmbedding(str(tmp_path / 'a.h5'), mmap_path=mmap_path)
+    mtime = os.path.getmtime(mmap_path)
+
+    GloveEmbedding(str(tmp_path / 'a.h5'), mmap_path=mmap_path)
+    assert os.path.getmtime(mmap_path) == mtime
+
+
+def test_wrong_shape_raise(tmp_path):
+    mmap_path = str(tmp_path / 'glove.npy')
+    write_h5(str(tmp_path / 'a.h5'), 20, 0)
+    GloveEmbedding(str(tmp_path / 'a.h5'), mmap_path=mmap_path)
+
+    np.save(mmap_path, np.zeros((30, 8), dtype=np.float32))
+    with pytest.raises(ValueError):
+        GloveEmbedding(str(tmp_path / 'a.h5'), mmap_path=mmap_path)
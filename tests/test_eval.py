@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import pytest
+from utils.eval import evaluate_batch, evaluate_em, evaluate_f1
+from dataset.preprocess_data import PreprocessData
+
+
+def gen_samples(lengths, context_len, max_candidates, vocab_size=6):
+    """
+    contexts of a small vocabulary that answers have repeated tokens, and dev style candidate answers
+    :return: context (batch, context_len), y_pred (batch, 2), y_true (batch, 2 * max_candidates)
+    """
+    batch_size = len(lengths)
+    context = torch.randint(1, vocab_size, (batch_size, context_len))
+    context = context.masked_fill(torch.arange(context_len).unsqueeze(0) >= torch.tensor(lengths).unsqueeze(1), 0)
+
+    y_pred = torch.zeros(batch_size, 2, dtype=torch.long)
+    y_true = torch.full((batch_size, 2 * max_candidates), PreprocessData.answer_padding_idx, dtype=torch.long)
+    for i, length in enumerate(lengths):
+        s = torch.randint(0, length, (1,)).item()
+        y_pred[i] = torch.tensor([s, min(s + torch.randint(0, 5, (1,)).item(), length - 1)])
+
+        candidates_num = torch.randint(1, max_candidates + 1, (1,)).item()
+        for j in range(candidates_num):
+            s = torch.randint(0, length, (1,)).item()
+            y_true[i, 2 * j:2 * j + 2] = torch.tensor([s, min(s + torch.randint(0, 5, (1,)).item(), length - 1)])
+
+    # some predictions are exactly one of the candidates
+    y_pred[::3] = y_true[::3, 0:2]
+    return context, y_pred, y_true
+
+
+@pytest.mark.parametrize('max_candidates', [1, 3])
+def test_batch_same_as_each_sample(max_candidates):
+    torch.manual_seed(0)
+    lengths = [20, 1, 7, 13, 20, 3, 9, 16, 2, 11]
+    context, y_pred, y_true = gen_samples(lengths, 20, max_candidates)
+
+    em, f1 = evaluate_batch(context, y_pred, y_true)
+    assert em.dtype == torch.bool and f1.dtype == torch.float64
+    for i in range(len(lengths)):
+        assert em[i].item() == evaluate_em(y_pred[i], y_true[i])
+        assert f1[i].item() == pytest.approx(evaluate_f1(context[i].tolist(), y_pred[i].tolist(), y_true[i].tolist()),
+                                             abs=1e-12)
+
+
+def test_empty_prediction():
+    """
+    the start is after the end, that no token is predicted
+    """
+    context = torch.tensor([[3, 4, 5, 3, 0]])
+    y_pred = torch.tensor([[3, 1]])
+    y_true = torch.tensor([[1, 3, PreprocessData.answer_padding_idx, PreprocessData.answer_padding_idx]])
+
+    em, f1 = evaluate_batch(context, y_pred, y_true)
+    assert not em[0].item()
+    assert f1[0].item() == evaluate_f1(context[0].tolist(), y_pred[0].tolist(), y_true[0].tolist()) == 0
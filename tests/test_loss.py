@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import math
+import torch
+import pytest
+import torch.nn.functional as F
+from models.loss import MyNLLLoss
+from dataset.preprocess_data import PreprocessData
+
+
+def gen_prop(batch_size, context_len, log_space):
+    """
+    :return: y_pred (batch, 2, context_len)
+    """
+    logits = torch.randn(batch_size, 2, context_len, dtype=torch.float64)
+    return torch.log_softmax(logits, dim=2) if log_space else torch.softmax(logits, dim=2)
+
+
+def gen_answers(answers_num, context_len):
+    """
+    dev style answer range, several spans of each sample padding with answer_padding_idx
+    :return: y_true (batch, 2 * max(answers_num))
+    """
+    y_true = torch.full((len(answers_num), 2 * max(answers_num)), PreprocessData.answer_padding_idx, dtype=torch.long)
+    for i, n in enumerate(answers_num):
+        starts = torch.randint(0, context_len, (n,))
+        ends = torch.min(starts + torch.randint(0, 4, (n,)), torch.tensor(context_len - 1))
+        y_true[i, :2 * n] = torch.stack([starts, ends], dim=1).view(-1)
+    return y_true
+
+
+def per_sample_loss(y_pred, y_true, log_space):
+    """
+    the loss looping on samples with the first answer only, as before vectorized
+    """
+    y_pred_log = y_pred if log_space else torch.log(y_pred)
+    loss = []
+    for i in range(y_pred.shape[0]):
+        tmp_loss = F.nll_loss(y_pred_log[i], y_true[i, :2], reduction='none')
+        loss.append(tmp_loss[0] + tmp_loss[1])
+    return torch.mean(torch.stack(loss))
+
+
+def brute_force_loss(y_pred, y_true, log_space):
+    """
+    negative log of the summed likelihood of every valid answer span, computed span by span
+    """
+    prop = y_pred.exp() if log_space else y_pred
+    loss = []
+    for p, spans in zip(prop.tolist(), y_true.tolist()):
+        likelihood = 0.
+        for s, e in zip(spans[0::2], spans[1::2]):
+            if s != PreprocessData.answer_padding_idx:
+                likelihood += p[0][s] * p[1][e]
+        loss.append(-math.log(likelihood))
+    return sum(loss) / len(loss)
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+def test_first_answer_same_as_per_sample(log_space):
+    torch.manual_seed(0)
+    y_pred = gen_prop(6, 10, log_space)
+    y_true = gen_answers([1, 3, 2, 1, 4, 2], 10)
+
+    expect = per_sample_loss(y_pred, y_true, log_space)
+    criterion = MyNLLLoss(log_space=log_space)
+    torch.testing.assert_close(criterion.forward(y_pred, y_true).double(), expect, rtol=1e-6, atol=0)
+    torch.testing.assert_close(criterion.forward(y_pred, y_true[:, :2]).double(), expect, rtol=1e-6, atol=0)
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+def test_multi_span_same_as_brute_force(log_space):
+    torch.manual_seed(1)
+    y_pred = gen_prop(6, 10, log_space)
+    y_true = gen_answers([1, 3, 2, 1, 4, 2], 10)
+
+    rtn = MyNLLLoss(multi_span=True, log_space=log_space).forward(y_pred, y_true)
+    expect = brute_force_loss(y_pred, y_true, log_space)
+    assert rtn.item() == pytest.approx(expect, rel=1e-6)
+
+    # the same as the first answer loss when every sample has only one answer
+    y_true = gen_answers([1, 1, 1, 1, 1, 1], 10)
+    rtn = MyNLLLoss(multi_span=True, log_space=log_space).forward(y_pred, y_true)
+    assert rtn.item() == pytest.approx(per_sample_loss(y_pred, y_true, log_space).item(), rel=1e-6)
+
+
+def test_multi_span_gradient():
+    torch.manual_seed(2)
+    logits = torch.randn(4, 2, 8, dtype=torch.float64, requires_grad=True)
+    y_true = gen_answers([2, 1, 3, 2], 8)
+
+    MyNLLLoss(multi_span=True, log_space=True).forward(torch.log_softmax(logits, dim=2), y_true).backward()
+    grad = logits.grad.clone()
+
+    logits.grad = None
+    expect = []
+    for i in range(y_true.shape[0]):
+        spans = y_true[i].view(-1, 2)
+        spans = spans[spans[:, 0].ne(PreprocessData.answer_padding_idx)]
+        prop = torch.softmax(logits[i], dim=1)
+        expect.append(-torch.log((prop[0, spans[:, 0]] * prop[1, spans[:, 1]]).sum()))
+    torch.mean(torch.stack(expect)).backward()
+    torch.testing.assert_close(grad, logits.grad)
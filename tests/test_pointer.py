@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import pytest
+from models.layers import BoundaryPointer, UniBoundaryPointer
+
+INPUT_SIZE = 6
+HIDDEN_SIZE = 5
+
+
+def gen_context(context_len=9, batch_size=4):
+    """
+    random context representation with different lengths, the first one is full
+    :return: Hr (context_len, batch, input_size), Hr_mask (batch, context_len)
+    """
+    Hr = torch.randn(context_len, batch_size, INPUT_SIZE)
+    lengths = torch.tensor([context_len] + [max(1, context_len - 2 * i - 1) for i in range(batch_size - 1)])
+    Hr_mask = (torch.arange(context_len).unsqueeze(0) < lengths.unsqueeze(1)).float()
+    return Hr, Hr_mask
+
+
+def uni_pointer_reference(ptr_rnn, Hr, Hr_mask, h_0):
+    """
+    answer steps of UniBoundaryPointer without reusing the context projection
+    """
+    hidden = (h_0, h_0) if ptr_rnn.mode == 'LSTM' else h_0
+    beta_out = []
+    for t in range(UniBoundaryPointer.answer_len):
+        attention_input = hidden[0] if ptr_rnn.mode == 'LSTM' else hidden
+        beta = ptr_rnn.attention.forward(Hr, Hr_mask, attention_input)
+        beta_out.append(beta)
+
+        if ptr_rnn.log_space:
+            beta = beta.exp()
+        context_beta = torch.bmm(beta.unsqueeze(1), Hr.transpose(0, 1)).squeeze(1)
+        hidden = ptr_rnn.hidden_cell.forward(context_beta, hidden)
+    return torch.stack(beta_out, dim=0)
+
+
+@pytest.mark.parametrize('mode', ['LSTM', 'GRU'])
+@pytest.mark.parametrize('log_space', [False, True])
+def test_uni_pointer_same_as_reference(mode, log_space):
+    torch.manual_seed(0)
+    ptr_rnn = UniBoundaryPointer(mode, INPUT_SIZE, HIDDEN_SIZE, log_space)
+    Hr, Hr_mask = gen_context()
+    h_0 = torch.randn(Hr.shape[1], HIDDEN_SIZE)
+
+    with torch.no_grad():
+        rtn = ptr_rnn.forward(Hr, Hr_mask, h_0)
+        expect = uni_pointer_reference(ptr_rnn, Hr, Hr_mask, h_0)
+    assert torch.equal(rtn, expect)
+
+
+@pytest.mark.parametrize('mode', ['LSTM', 'GRU'])
+@pytest.mark.parametrize('log_space', [False, True])
+@pytest.mark.parametrize('with_h_0', [False, True])
+def test_batched_directions_same_as_each_direction(mode, log_space, with_h_0):
+    torch.manual_seed(0)
+    pointer = BoundaryPointer(mode, INPUT_SIZE, HIDDEN_SIZE, bidirectional=True, dropout_p=0., log_space=log_space)
+    pointer.eval()
+    Hr, Hr_mask = gen_context()
+    h_0 = torch.randn(Hr.shape[1], HIDDEN_SIZE * 2) if with_h_0 else None
+    h_0_left, h_0_right = torch.split(h_0, HIDDEN_SIZE, dim=1) if with_h_0 else (None, None)
+
+    assert pointer.batch_directions_enabled()
+    with torch.no_grad():
+        left_beta, right_beta_inv = pointer.forward_batched(Hr, Hr_mask, h_0_left, h_0_right)
+        expect_left = pointer.left_ptr_rnn.forward(Hr, Hr_mask, h_0_left)
+        expect_right = pointer.right_ptr_rnn.forward(Hr, Hr_mask, h_0_right)
+
+    # masked positions are -inf in log space
+    torch.testing.assert_close(left_beta, expect_left, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(right_beta_inv, expect_right, rtol=1e-5, atol=1e-6)
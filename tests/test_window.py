@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import h5py
+import yaml
+import torch
+import numpy as np
+import pytest
+from models.match_lstm import MatchLSTMModel
+from utils.functions import window_starts
+
+WINDOW_SIZE = 6
+WINDOW_STRIDE = 4
+MAX_TOKENS = 15
+
+
+@pytest.fixture
+def global_config(tmp_path):
+    """
+    small model without char-level encoding on a fake hdf5 file, that only has the glove table
+    """
+    dataset_h5 = str(tmp_path / 'squad.h5')
+    with h5py.File(dataset_h5, 'w') as f:
+        f.create_group('meta_data').create_dataset('id2vec', data=np.random.RandomState(0).rand(200, 8)
+                                                   .astype(np.float32))
+
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config/model_config.yaml')
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f.read())
+    config['data']['dataset_h5'] = dataset_h5
+    config['data']['embedding_mmap_path'] = None
+    config['data']['window_size'] = WINDOW_SIZE
+    config['data']['window_stride'] = WINDOW_STRIDE
+    config['model']['global']['hidden_size'] = 4
+    config['model']['encoder']['word_embedding_size'] = 8
+    config['model']['encoder']['enable_char'] = False
+    return config
+
+
+def gen_batch(lengths, context_len, question_len=4):
+    """
+    random word ids with padding, some contexts are longer than window size and some are not
+    :return: context (batch, context_len), question (batch, question_len)
+    """
+    context = torch.randint(1, 200, (len(lengths), context_len))
+    context = context.masked_fill(torch.arange(context_len).unsqueeze(0) >= torch.tensor(lengths).unsqueeze(1), 0)
+    question = torch.randint(1, 200, (len(lengths), question_len))
+    return context, question
+
+
+def brute_force_windows(model, context, question):
+    """
+    predict each window of each sample alone on the whole window, without the padding of short context
+    :return: list of [(start, window ans_range_prop (2, window_len), window_len)] of each sample
+    """
+    rtn = []
+    for i, length in enumerate(context.ne(0).sum(1).tolist()):
+        windows = []
+        for start in window_starts(length, WINDOW_SIZE, WINDOW_STRIDE):
+            window_len = min(length - start, WINDOW_SIZE)
+            with torch.no_grad():
+                prop, _, _ = model.forward_context(context[i:i + 1, start:start + window_len], question[i:i + 1])
+            windows.append((start, prop[0], window_len))
+        rtn.append(windows)
+    return rtn
+
+
+def answers_of_window(prop, window_len, log_space):
+    """
+    score of every answer no more than MAX_TOKENS in the window
+    :return: list of (score, (start, end)) in the window
+    """
+    answers = []
+    for s in range(window_len):
+        for e in range(s, min(s + MAX_TOKENS, window_len)):
+            score = prop[0, s] + prop[1, e] if log_space else prop[0, s] * prop[1, e]
+            answers.append((score.item(), (s, e)))
+    return answers
+
+
+@pytest.mark.parametrize('length', [1, 5, 6, 7, 10, 14, 23])
+@pytest.mark.parametrize('window_stride', [1, 4, 6])
+def test_window_starts(length, window_stride):
+    starts = window_starts(length, WINDOW_SIZE, window_stride)
+
+    # every window is full and inside the sequence when it is longer than window size, the first one starts at 0
+    assert starts[0] == 0
+    assert all(s + WINDOW_SIZE <= max(length, WINDOW_SIZE) for s in starts)
+    assert all(0 < b - a <= window_stride for a, b in zip(starts, starts[1:]))
+
+    # every position is covered
+    covered = set(p for s in starts for p in range(s, s + WINDOW_SIZE))
+    assert set(range(length)) <= covered
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+def test_forward_windows_same_as_each_window(global_config, log_space):
+    global_config['model']['output']['log_space'] = log_space
+    torch.manual_seed(0)
+    model = MatchLSTMModel(global_config)
+    model.eval()
+
+    lengths = [14, 9, 5, 6]
+    context, question = gen_batch(lengths, 14)
+    assert model.is_windowed(context)
+    with torch.no_grad():
+        ans_range_prop, ans_range, _ = model.forward(context, question)
+
+    padding_prop = float('-inf') if log_space else 0.
+    expect_prop = torch.full((len(lengths), 2, 14), padding_prop)
+    for i, windows in enumerate(brute_force_windows(model, context, question)):
+        # the best answer of every window, the first window is selected on ties
+        best = None
+        for start, prop, window_len in windows:
+            score, (s, e) = max(answers_of_window(prop, window_len, log_space), key=lambda x: x[0])
+            if best is None or score > best[0] + 1e-6:
+                best = (score, (start + s, start + e))
+            expect_prop[i, :, start:start + window_len] = torch.max(expect_prop[i, :, start:start + window_len], prop)
+        assert tuple(ans_range[i].tolist()) == best[1]
+
+    # padding is not compared, that log space masks it with a large negative score instead of -inf,
+    # and the window of short context is padded in the batch, which only changes float rounding
+    ans_range_prop = ans_range_prop.masked_fill(context.eq(0).unsqueeze(1), padding_prop)
+    torch.testing.assert_close(ans_range_prop, expect_prop, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+def test_predict_nbest_windows_same_as_each_window(global_config, log_space):
+    global_config['model']['output']['log_space'] = log_space
+    torch.manual_seed(1)
+    model = MatchLSTMModel(global_config)
+    model.eval()
+
+    k = 5
+    lengths = [14, 9, 2, 11]
+    context, question = gen_batch(lengths, 14)
+    with torch.no_grad():
+        ans_range, ans_score = model.predict_nbest_windows(context, question, k=k)
+
+    # the same answer of overlapped windows keeps the best score
+    for i, windows in enumerate(brute_force_windows(model, context, question)):
+        candidates = {}
+        for start, prop, window_len in windows:
+            for score, (s, e) in answers_of_window(prop, window_len, log_space):
+                a = (start + s, start + e)
+                candidates[a] = max(score, candidates.get(a, float('-inf')))
+        expect = sorted(candidates.items(), key=lambda x: x[1], reverse=True)[:k]
+
+        n = len(expect)
+        assert [tuple(a) for a in ans_range[i, :n].tolist()] == [a for a, _ in expect]
+        torch.testing.assert_close(ans_score[i, :n], torch.tensor([s for _, s in expect]), rtol=1e-4, atol=1e-5)
+        assert all(s == float('-inf') for s in ans_score[i, n:].tolist())
+
+
+@pytest.mark.parametrize('window_stride', [0, -1, WINDOW_SIZE + 1])
+def test_wrong_window_stride_raise(global_config, window_stride):
+    global_config['data']['window_stride'] = window_stride
+    with pytest.raises(ValueError):
+        MatchLSTMModel(global_config)
@@ -4,25 +4,64 @@
 __author__ = 'han'
 
 import os
+import time
 import torch
 import logging
 import argparse
 import torch.optim as optim
+import torch.multiprocessing as mp
+import torch.distributed as dist
 from dataset.squad_dataset import SquadDataset
 from models.match_lstm import MatchLSTMModel
 from models.loss import MyNLLLoss
+from dataset.preprocess_data import PreprocessData
 from utils.load_config import init_logging, read_config
-from utils.eval import eval_on_model
-from utils.functions import pop_dict_keys
+from utils.eval import eval_valid_on_model
+from utils.functions import pop_dict_keys, split_micro_batches, set_torch_threads
+from utils.checkpoint import get_rng_state, set_rng_state, model_state_without_embedding, save_checkpoint, \
+    load_checkpoint, AsyncCheckpointWriter
+from utils.metrics import MetricsWriter, StepTimer, peak_memory_mb
+from utils.async_valid import AsyncValidator
+from utils.distributed import init_distributed, broadcast_parameters, all_reduce_gradients, all_reduce_sum, \
+    all_gather_object, broadcast_flag
 
 init_logging()
 logger = logging.getLogger(__name__)
 
 
-def main(config_path):
+def main(config_path, overlay_paths=None):
     logger.info('------------Match-LSTM Train--------------')
     logger.info('loading config file...')
-    global_config = read_config(config_path)
+    global_config = read_config(config_path, overlay_paths)
+
+    world_size = global_config['train']['world_size']
+    if world_size > 1:
+        logger.info('spawning %d training processes...' % world_size)
+        mp.spawn(train_process, args=(global_config, world_size), nprocs=world_size)
+    else:
+        train_process(0, global_config, 1)
+
+    logger.info('finished.')
+
+
+def train_process(rank, global_config, world_size, dataset=None):
+    """
+    training on one process, with world_size > 1 every process trains on its shard of batches and
+    gradients are averaged before each optimizer step. only rank 0 evaluates and saves
+    :param rank:
+    :param global_config:
+    :param world_size:
+    :param dataset: loaded SquadDataset, such as shared by a forked process pool, or None to load here
+    :return: dict of epoch, loss of the last epoch, best_valid_em, best_valid_f1, early_stopped and time
+    """
+    # threads of each process, split cpu evenly between processes by default
+    num_threads = global_config['train']['num_threads']
+    if world_size > 1 and num_threads <= 0:
+        num_threads = max(1, os.cpu_count() // world_size)
+    set_torch_threads(num_threads, global_config['train']['num_interop_threads'])
+
+    if world_size > 1:
+        init_distributed(rank, world_size, global_config['train']['dist_port'])
 
     # set random seed
     seed = global_config['model']['global']['random_seed']
@@ -35,12 +74,15 @@ def main(config_path):
     elif not torch.cuda.is_available() and enable_cuda:
         raise ValueError("CUDA is not abaliable, please unable CUDA in config file")
 
-    logger.info('reading squad dataset...')
-    dataset = SquadDataset(global_config)
+    if dataset is None:
+        logger.info('reading squad dataset...')
+        dataset = SquadDataset(global_config)
 
     logger.info('constructing model...')
     model = MatchLSTMModel(global_config).to(device)
-    criterion = MyNLLLoss()
+    model.enable_autocast = global_config['train']['bf16_autocast']
+    criterion = MyNLLLoss(multi_span=global_config['model']['output']['multi_span'],
+                          log_space=global_config['model']['output']['log_space'])
 
     # optimizer
     optimizer_choose = global_config['train']['optimizer']
@@ -59,9 +101,15 @@ def main(config_path):
     else:
         raise ValueError('optimizer "%s" in config file not recoginized' % optimizer_choose)
 
-    # check if exist model weight
+    # resume from checkpoint, or check if exist model weight
+    checkpoint_path = global_config['data']['checkpoint_path']
+    checkpoint = load_checkpoint(checkpoint_path)
     weight_path = global_config['data']['model_path']
-    if os.path.exists(weight_path):
+    if checkpoint is not None:
+        logger.info('resuming from checkpoint on epoch=%d, batch=%d...' % (checkpoint['epoch'], checkpoint['batch']))
+        model.load_state_dict(checkpoint['model'], strict=False)
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    elif os.path.exists(weight_path):
         logger.info('loading existing weight...')
         weight = torch.load(weight_path, map_location=lambda storage, loc: storage)
         if enable_cuda:
@@ -69,6 +117,11 @@ def main(config_path):
         # weight = pop_dict_keys(weight, ['pointer', 'init_ptr_hidden'])  # partial initial weight
         model.load_state_dict(weight, strict=False)
 
+    # same start weights on all processes, and different dropout
+    if world_size > 1:
+        broadcast_parameters(model)
+        torch.manual_seed(seed + rank)
+
     # training arguments
     logger.info('start training...')
     train_batch_size = global_config['train']['batch_size']
@@ -76,54 +129,184 @@ def main(config_path):
 
     # batch_train_data = dataset.get_dataloader_train(train_batch_size)
     # batch_dev_data = dataset.get_dataloader_dev(valid_batch_size)
-    batch_train_data = list(dataset.get_batch_train(train_batch_size))
-    batch_dev_data = list(dataset.get_batch_dev(valid_batch_size))
+    batch_train_data = list(dataset.get_batch_train(train_batch_size, rank, world_size))
+
+    # only the small dev subset kept in memory, the whole dev set batches are generated when validating
+    valid_subset_size = global_config['train']['valid_subset_size']
+    async_valid = global_config['train']['async_valid']
+    batch_subset_data = None
+    if rank == 0 and valid_subset_size > 0 and not async_valid:
+        batch_subset_data = list(dataset.get_batch_dev_subset(valid_batch_size, valid_subset_size, seed))
 
     clip_grad_max = global_config['train']['clip_grad_norm']
+    accumulation_steps = global_config['train']['accumulation_steps']
+    max_batch_tokens = global_config['train']['max_batch_tokens']
+    checkpoint_interval = global_config['train']['checkpoint_interval']
+    valid_interval = global_config['train']['valid_interval']
     enable_char = global_config['model']['encoder']['enable_char']
 
-    best_valid_f1 = None
-    # every epoch
-    for epoch in range(global_config['train']['epoch']):
-        # train
-        model.train()  # set training = True, make sure right dropout
-        sum_loss = train_on_model(model=model,
+    start_epoch = 0
+    start_batch = 0
+    start_loss = 0.
+    valid_state = {'best_valid_em': None, 'best_valid_f1': None, 'best_subset_f1': None, 'bad_count': 0,
+                   'stop': False}
+    if checkpoint is not None:
+        start_epoch = checkpoint['epoch']
+        valid_state = checkpoint['valid_state']
+
+        # batch position and random states are different on each process
+        if len(checkpoint['ranks']) == world_size:
+            start_batch = checkpoint['batch']
+            start_loss = checkpoint['ranks'][rank]['sum_loss']
+            set_rng_state(checkpoint['ranks'][rank]['rng_state'])
+        else:
+            logger.warning('checkpoint saved with %d processes, restart epoch=%d with %d processes'
+                           % (len(checkpoint['ranks']), start_epoch, world_size))
+        del checkpoint
+
+    def checkpoint_func(epoch, batch, sum_loss):
+        if checkpoint_path is None:
+            return
+
+        rank_states = [{'rng_state': get_rng_state(), 'sum_loss': sum_loss}]
+        if world_size > 1:
+            rank_states = all_gather_object(rank_states[0], world_size)
+        if rank == 0:
+            save_train_checkpoint(model, optimizer, epoch, batch, rank_states, valid_state, checkpoint_path, writer)
+
+    def valid_func(epoch, batch):
+        stop = False
+        if rank == 0 and validator is not None:
+            stop = async_valid_on_model(model=model,
+                                        validator=validator,
+                                        global_config=global_config,
+                                        valid_state=valid_state,
+                                        epoch=epoch,
+                                        batch=batch,
+                                        batch_cnt=len(batch_train_data),
+                                        metrics=metrics)
+        elif rank == 0:
+            stop = valid_on_model(model=model,
                                   criterion=criterion,
-                                  optimizer=optimizer,
-                                  batch_data=batch_train_data,
+                                  dataset=dataset,
+                                  batch_subset_data=batch_subset_data,
+                                  global_config=global_config,
+                                  valid_state=valid_state,
                                   epoch=epoch,
-                                  clip_grad_max=clip_grad_max,
+                                  batch=batch,
+                                  batch_cnt=len(batch_train_data),
                                   device=device,
-                                  enable_char=enable_char,
-                                  batch_char_func=dataset.gen_batch_with_char)
-        logger.info('epoch=%d, sum_loss=%.5f' % (epoch, sum_loss))
-
-        # evaluate
-        with torch.no_grad():
-            model.eval()  # let training = False, make sure right dropout
-            valid_score_em, valid_score_f1, valid_loss = eval_on_model(model=model,
-                                                                       criterion=criterion,
-                                                                       batch_data=batch_dev_data,
-                                                                       epoch=epoch,
-                                                                       device=device,
-                                                                       enable_char=enable_char,
-                                                                       batch_char_func=dataset.gen_batch_with_char)
-        logger.info("epoch=%d, ave_score_em=%.2f, ave_score_f1=%.2f, sum_loss=%.5f" %
-                    (epoch, valid_score_em, valid_score_f1, valid_loss))
-
-        # save model when best f1 score
-        if best_valid_f1 is None or valid_score_f1 > best_valid_f1:
-            save_model(model,
-                       epoch=epoch,
-                       model_weight_path=global_config['data']['model_path'],
-                       checkpoint_path=global_config['data']['checkpoint_path'])
-            logger.info("saving model weight on epoch=%d" % epoch)
-            best_valid_f1 = valid_score_f1
-
-    logger.info('finished.')
-
-
-def train_on_model(model, criterion, optimizer, batch_data, epoch, clip_grad_max, device, enable_char, batch_char_func):
+                                  metrics=metrics,
+                                  writer=writer)
+
+        # every process stops together
+        if world_size > 1:
+            stop = broadcast_flag(stop)
+        valid_state['stop'] = stop
+        return stop
+
+    # checkpoints are written on background thread, only from rank 0
+    writer = None
+    if rank == 0 and global_config['train']['async_checkpoint']:
+        writer = AsyncCheckpointWriter()
+
+    # metrics of rank 0
+    metrics = None
+    if rank == 0 and global_config['train']['metrics_path'] is not None:
+        metrics = MetricsWriter(global_config['train']['metrics_path'])
+    train_size = sum(map(lambda x: x[0].shape[0], batch_train_data)) * world_size
+
+    # validation on a background process of rank 0, training goes on without waiting for the scores
+    validator = None
+    if rank == 0 and async_valid:
+        validator = AsyncValidator(global_config, valid_state['best_subset_f1'])
+
+    result = {'epoch': start_epoch, 'loss': None}
+    next_epoch = start_epoch
+    train_start_time = time.time()
+    try:
+        # every epoch
+        for epoch in range(start_epoch, global_config['train']['epoch']):
+            if valid_state['stop']:
+                logger.info('early stopped before epoch=%d' % epoch)
+                break
+
+            # train
+            model.train()  # set training = True, make sure right dropout
+            start_time = time.time()
+            sum_loss = train_on_model(model=model,
+                                      criterion=criterion,
+                                      optimizer=optimizer,
+                                      batch_data=batch_train_data,
+                                      epoch=epoch,
+                                      clip_grad_max=clip_grad_max,
+                                      device=device,
+                                      enable_char=enable_char,
+                                      batch_char_func=dataset.gen_batch_with_char,
+                                      accumulation_steps=accumulation_steps,
+                                      max_batch_tokens=max_batch_tokens,
+                                      start_batch=start_batch,
+                                      start_loss=start_loss,
+                                      checkpoint_func=checkpoint_func,
+                                      checkpoint_interval=checkpoint_interval,
+                                      world_size=world_size,
+                                      metrics=metrics,
+                                      valid_func=valid_func,
+                                      valid_interval=valid_interval)
+            start_batch = 0
+            start_loss = 0.
+            if world_size > 1:
+                sum_loss = all_reduce_sum(sum_loss)
+            epoch_time = time.time() - start_time
+            logger.info('epoch=%d, sum_loss=%.5f, time=%.2fs' % (epoch, sum_loss, epoch_time))
+            if metrics is not None:
+                metrics.write('epoch', epoch=epoch, samples=train_size, sum_loss=sum_loss, loss=sum_loss / train_size,
+                              time=epoch_time)
+            result['epoch'] = epoch + 1
+            result['loss'] = sum_loss / train_size
+
+            # validate on the end of epoch, if not stopped in the epoch
+            if not valid_state['stop']:
+                valid_func(epoch, len(batch_train_data))
+
+            # checkpoint to start the next epoch
+            checkpoint_func(epoch + 1, 0, 0.)
+            next_epoch = epoch + 1
+
+        # results of the last background validations, saved to the checkpoint again
+        if async_valid:
+            drained = False
+            if validator is not None:
+                results = validator.collect(0)
+                apply_async_valid(results, global_config, valid_state, len(batch_train_data), metrics)
+                drained = len(results) > 0
+            if world_size > 1:
+                drained = broadcast_flag(drained)
+            if drained:
+                checkpoint_func(next_epoch, 0, 0.)
+    finally:
+        if validator is not None:
+            validator.close()
+
+        # wait for the last checkpoints, also when training is broken
+        if writer is not None:
+            writer.close()
+        if metrics is not None:
+            metrics.close()
+
+    if world_size > 1:
+        dist.destroy_process_group()
+
+    result['best_valid_em'] = valid_state.get('best_valid_em')
+    result['best_valid_f1'] = valid_state['best_valid_f1']
+    result['early_stopped'] = valid_state['stop']
+    result['time'] = time.time() - train_start_time
+    return result
+
+
+def train_on_model(model, criterion, optimizer, batch_data, epoch, clip_grad_max, device, enable_char, batch_char_func,
+                   accumulation_steps=1, max_batch_tokens=0, start_batch=0, start_loss=0., checkpoint_func=None,
+                   checkpoint_interval=0, world_size=1, metrics=None, valid_func=None, valid_interval=0):
     """
     train on every batch
     :param enable_char:
@@ -135,63 +318,281 @@ def train_on_model(model, criterion, optimizer, batch_data, epoch, clip_grad_max
     :param epoch:
     :param clip_grad_max:
     :param device:
+    :param accumulation_steps: batches of gradient accumulated before one optimizer step
+    :param max_batch_tokens: split batch to micro-batches with no more than these context tokens, 0 means no split
+    :param start_batch: batch index to continue the epoch from, that resumed from checkpoint
+    :param start_loss: sum loss of batches before start_batch
+    :param checkpoint_func: called with (epoch, next batch index, sum_loss) to save checkpoint after optimizer step
+    :param checkpoint_interval: optimizer steps between checkpoints, 0 means never
+    :param world_size: count of training processes, that gradients are averaged on before optimizer step
+    :param metrics: MetricsWriter to record throughput and time of every phase on each batch, or None
+    :param valid_func: called with (epoch, next batch index) to validate after optimizer step, stop the epoch
+     when it returns True
+    :param valid_interval: optimizer steps between validations, 0 means never
     :return:
     """
     batch_cnt = len(batch_data)
-    sum_loss = 0.
-    for i, batch in enumerate(batch_data):
-        optimizer.zero_grad()
+    sum_loss = start_loss
+    accumulation_size = 0
+    timer = StepTimer()
+    for i, batch in enumerate(batch_data[start_batch:], start_batch):
+        # samples of all batches in this step, that loss is the mean on them
+        if i % accumulation_steps == 0:
+            optimizer.zero_grad()
+            accumulation_size = sum(map(lambda x: x[0].shape[0], batch_data[i:i + accumulation_steps]))
+
+        batch_loss = 0.
+        batch_size = batch[0].shape[0]
+        micro_batches = split_micro_batches(batch, max_batch_tokens)
+        timer.lap('data')
+
+        for micro_batch in micro_batches:
+            # batch data
+            bat_context, bat_question, bat_context_char, bat_question_char, bat_answer_range = \
+                batch_char_func(micro_batch, enable_char=enable_char, device=device)
+            micro_size = bat_answer_range.shape[0]
+            timer.lap('char')
+
+            # forward
+            ans_range_prop, _, _ = model.forward(bat_context, bat_question, bat_context_char, bat_question_char)
+
+            # get loss
+            loss = criterion.forward(ans_range_prop, bat_answer_range)
+            timer.lap('forward')
+
+            (loss * micro_size / accumulation_size).backward()
+            batch_loss += loss.item() * micro_size / batch_size
+            timer.lap('backward')
+
+            # manual release memory, todo: really effect?
+            del bat_context, bat_question, bat_answer_range, bat_context_char, bat_question_char
+            del ans_range_prop, loss
+            # torch.cuda.empty_cache()
+
+        step_end = (i + 1) % accumulation_steps == 0 or i == batch_cnt - 1
+        if step_end:
+            if world_size > 1:
+                all_reduce_gradients(model, world_size)
+                timer.lap('all_reduce')
+            torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_max)  # fix gradient explosion
+            timer.lap('clip')
+            optimizer.step()  # update parameters
+            timer.lap('optimizer')
 
-        # batch data
-        bat_context, bat_question, bat_context_char, bat_question_char, bat_answer_range = \
-            batch_char_func(batch, enable_char=enable_char, device=device)
-
-        # forward
-        ans_range_prop, _, _ = model.forward(bat_context, bat_question, bat_context_char, bat_question_char)
+        # logging
+        sum_loss += batch_loss * batch_size
 
-        # get loss
-        loss = criterion.forward(ans_range_prop, bat_answer_range)
-        loss.backward()
+        logger.info('epoch=%d, batch=%d/%d, loss=%.5f' % (epoch, i, batch_cnt, batch_loss))
+        if metrics is not None:
+            step_time = timer.total()
+            batch_tokens = sum(map(lambda x: x.ne(PreprocessData.padding_idx).sum().item(), batch[:2]))
+            metrics.write('train',
+                          epoch=epoch,
+                          batch=i,
+                          batch_cnt=batch_cnt,
+                          step_end=step_end,
+                          samples=batch_size,
+                          tokens=batch_tokens,
+                          loss=batch_loss,
+                          time=timer.times,
+                          step_time=step_time,
+                          samples_per_sec=batch_size / step_time,
+                          tokens_per_sec=batch_tokens / step_time,
+                          peak_memory_mb=peak_memory_mb(device))
+
+        # the end of epoch is validated and saved outside
+        step_num = (i + 1) // accumulation_steps
+        if valid_func is not None and valid_interval > 0 and step_end and i < batch_cnt - 1 \
+                and step_num % valid_interval == 0:
+            if valid_func(epoch, i + 1):
+                break
+
+        if checkpoint_func is not None and checkpoint_interval > 0 and step_end and i < batch_cnt - 1 \
+                and step_num % checkpoint_interval == 0:
+            checkpoint_func(epoch, i + 1, sum_loss)
+
+        timer = StepTimer()
 
-        torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_max)  # fix gradient explosion
-        optimizer.step()  # update parameters
+    return sum_loss
 
-        # logging
-        batch_loss = loss.item()
-        sum_loss += batch_loss * bat_answer_range.shape[0]
 
-        logger.info('epoch=%d, batch=%d/%d, loss=%.5f' % (epoch, i, batch_cnt, batch_loss))
+def valid_on_model(model, criterion, dataset, batch_subset_data, global_config, valid_state, epoch, batch, batch_cnt,
+                   device, metrics=None, writer=None):
+    """
+    validate on the fixed dev subset, and on the whole dev set only when the subset f1 improved.
+    save model weight when the whole dev f1 improved, and count validations without improvement for early stopping
+    :param model:
+    :param criterion:
+    :param dataset:
+    :param batch_subset_data: batches of dev subset, or None to always validate on the whole dev set
+    :param global_config:
+    :param valid_state: dict of 'best_valid_em', 'best_valid_f1', 'best_subset_f1' and 'bad_count', updated here
+    :param epoch:
+    :param batch: next batch index in the epoch
+    :param batch_cnt: count of batches in the epoch
+    :param device:
+    :param metrics:
+    :param writer:
+    :return: whether to stop training
+    """
+    model.eval()  # let training = False, make sure right dropout
+    with torch.no_grad():
+        scores = eval_valid_on_model(model=model,
+                                     criterion=criterion,
+                                     dataset=dataset,
+                                     batch_subset_data=batch_subset_data,
+                                     global_config=global_config,
+                                     best_subset_f1=valid_state['best_subset_f1'],
+                                     epoch=epoch,
+                                     batch=batch,
+                                     device=device)
+    model.train()
+
+    return update_valid_state(scores=scores,
+                              valid_state=valid_state,
+                              global_config=global_config,
+                              epoch=epoch,
+                              batch=batch,
+                              batch_cnt=batch_cnt,
+                              save_func=lambda: save_model(model,
+                                                           model_weight_path=global_config['data']['model_path'],
+                                                           writer=writer),
+                              metrics=metrics)
+
+
+def async_valid_on_model(model, validator, global_config, valid_state, epoch, batch, batch_cnt, metrics=None):
+    """
+    apply the finished validations of the background process, and send the current weights to validate.
+    wait only when too many validations pending
+    :param model:
+    :param validator: AsyncValidator
+    :param global_config:
+    :param valid_state:
+    :param epoch:
+    :param batch: next batch index in the epoch
+    :param batch_cnt: count of batches in the epoch
+    :param metrics:
+    :return: whether to stop training, by the finished validations
+    """
+    stop = apply_async_valid(validator.collect(validator.max_pending - 1), global_config, valid_state, batch_cnt,
+                             metrics)
+    if not stop:
+        validator.submit(model, epoch, batch)
+    return stop
 
-        # manual release memory, todo: really effect?
-        del bat_context, bat_question, bat_answer_range, bat_context_char, bat_question_char
-        del ans_range_prop, loss
-        # torch.cuda.empty_cache()
 
-    return sum_loss
+def apply_async_valid(results, global_config, valid_state, batch_cnt, metrics=None):
+    """
+    update valid state with results of the background validations on their order,
+    the validated weight file is moved to model_path when improved
+    :param results: list of (epoch, batch, weight_path, scores) from AsyncValidator
+    :return: whether to stop training
+    """
+    stop = False
+    for epoch, batch, weight_path, scores in results:
+        stop = update_valid_state(scores=scores,
+                                  valid_state=valid_state,
+                                  global_config=global_config,
+                                  epoch=epoch,
+                                  batch=batch,
+                                  batch_cnt=batch_cnt,
+                                  save_func=lambda: os.replace(weight_path, global_config['data']['model_path']),
+                                  metrics=metrics) or stop
+    return stop
 
 
-def save_model(model, epoch, model_weight_path, checkpoint_path):
+def update_valid_state(scores, valid_state, global_config, epoch, batch, batch_cnt, save_func, metrics=None):
+    """
+    update best scores and count of validations without improvement, with scores of `eval_valid_on_model`
+    :param scores:
+    :param valid_state:
+    :param global_config:
+    :param epoch:
+    :param batch:
+    :param batch_cnt:
+    :param save_func: save the validated model weight, called when the whole dev f1 improved
+    :param metrics:
+    :return: whether to stop training
+    """
+    patience = global_config['train']['early_stop_patience']
+
+    if scores['subset'] is not None:
+        subset_em, subset_f1, subset_loss, subset_size = scores['subset']
+        if metrics is not None:
+            metrics.write('valid_subset', epoch=epoch, batch=batch, batch_cnt=batch_cnt, samples=subset_size,
+                          em=subset_em, f1=subset_f1, sum_loss=subset_loss, loss=subset_loss / subset_size)
+        if valid_state['best_subset_f1'] is None or subset_f1 > valid_state['best_subset_f1']:
+            valid_state['best_subset_f1'] = subset_f1
+
+    # save model when best f1 score
+    improved = False
+    if scores['valid'] is not None:
+        valid_score_em, valid_score_f1, valid_loss, dev_size = scores['valid']
+        if metrics is not None:
+            metrics.write('valid', epoch=epoch, batch=batch, batch_cnt=batch_cnt, samples=dev_size,
+                          em=valid_score_em, f1=valid_score_f1, sum_loss=valid_loss, loss=valid_loss / dev_size)
+
+        improved = valid_state['best_valid_f1'] is None or valid_score_f1 > valid_state['best_valid_f1']
+        if improved:
+            save_func()
+            logger.info("saving model weight on epoch=%d, batch=%d" % (epoch, batch))
+            valid_state['best_valid_em'] = valid_score_em
+            valid_state['best_valid_f1'] = valid_score_f1
+
+    valid_state['bad_count'] = 0 if improved else valid_state['bad_count'] + 1
+    if 0 < patience <= valid_state['bad_count']:
+        logger.info('early stopping on epoch=%d, batch=%d, no improvement in %d validations'
+                    % (epoch, batch, valid_state['bad_count']))
+        return True
+    return False
+
+
+def save_model(model, model_weight_path, writer=None):
     """
     save model weight without embedding
     :param model:
-    :param epoch:
     :param model_weight_path:
-    :param checkpoint_path:
+    :param writer: AsyncCheckpointWriter to write on background, or None to write now
     :return:
     """
-    # save model weight
-    model_weight = model.state_dict()
-    del model_weight['embedding.embedding_layer.weight']
+    save_state(model_state_without_embedding(model), model_weight_path, writer)
 
-    torch.save(model_weight, model_weight_path)
 
-    with open(checkpoint_path, 'w') as checkpoint_f:
-        checkpoint_f.write('epoch=%d' % epoch)
+def save_train_checkpoint(model, optimizer, epoch, batch, rank_states, valid_state, checkpoint_path, writer=None):
+    """
+    save all the training states that could be resumed from
+    :param model:
+    :param optimizer:
+    :param epoch: epoch to continue
+    :param batch: batch index in the epoch shard of each process to continue
+    :param rank_states: list of dict with 'rng_state' and 'sum_loss' of the epoch before batch, on each process
+    :param valid_state: dict of best f1 scores and count of validations without improvement
+    :param checkpoint_path:
+    :param writer: AsyncCheckpointWriter to write on background, or None to write now
+    :return:
+    """
+    state = {'model': model_state_without_embedding(model),
+             'optimizer': optimizer.state_dict(),
+             'epoch': epoch,
+             'batch': batch,
+             'valid_state': valid_state,
+             'ranks': rank_states}
+    save_state(state, checkpoint_path, writer)
+    logger.info('saving checkpoint on epoch=%d, batch=%d' % (epoch, batch))
+
+
+def save_state(state, path, writer=None):
+    if writer is not None:
+        writer.save(state, path)
+    else:
+        save_checkpoint(state, path)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="train on the model")
     parser.add_argument('--config', '-c', required=False, dest='config_path', default='config/model_config.yaml')
+    parser.add_argument('--overlay', required=False, nargs='+', dest='overlay_paths', default=None,
+                        help='config files override part of config, such as output of helper_run/autotune.py')
     args = parser.parse_args()
 
-    main(args.config_path)
+    main(args.config_path, args.overlay_paths)
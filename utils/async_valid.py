@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import queue
+import torch
+import logging
+import torch.multiprocessing as mp
+from dataset.squad_dataset import SquadDataset
+from models.match_lstm import MatchLSTMModel
+from models.loss import MyNLLLoss
+from utils.eval import eval_valid_on_model
+from utils.functions import set_torch_threads
+from utils.checkpoint import model_state_without_embedding, save_checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+def valid_process(global_config, best_subset_f1, request_queue, result_queue):
+    """
+    validation loop on a separate process, with its own dataset and model. every request is a weight file to load,
+    and the scores are put back on the same order
+    :param global_config:
+    :param best_subset_f1: best f1 on dev subset before, the whole dev set is validated only when it improved
+    :param request_queue: (epoch, batch, weight_path), or None to exit
+    :param result_queue: (epoch, batch, weight_path, scores)
+    :return:
+    """
+    set_torch_threads(global_config['train']['valid_num_threads'], 0)
+    torch.manual_seed(global_config['model']['global']['random_seed'])
+
+    device = torch.device("cuda" if global_config['train']['enable_cuda'] else "cpu")
+    dataset = SquadDataset(global_config)
+    model = MatchLSTMModel(global_config).to(device)
+    model.enable_autocast = global_config['train']['bf16_autocast']
+    model.eval()
+    criterion = MyNLLLoss(multi_span=global_config['model']['output']['multi_span'],
+                          log_space=global_config['model']['output']['log_space'])
+
+    batch_subset_data = None
+    valid_subset_size = global_config['train']['valid_subset_size']
+    if valid_subset_size > 0:
+        batch_subset_data = list(dataset.get_batch_dev_subset(global_config['train']['valid_batch_size'],
+                                                              valid_subset_size,
+                                                              global_config['model']['global']['random_seed']))
+
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+
+        epoch, batch, weight_path = request
+        weight = torch.load(weight_path, map_location=lambda storage, loc: storage)
+        model.load_state_dict(weight, strict=False)
+
+        with torch.no_grad():
+            scores = eval_valid_on_model(model=model,
+                                         criterion=criterion,
+                                         dataset=dataset,
+                                         batch_subset_data=batch_subset_data,
+                                         global_config=global_config,
+                                         best_subset_f1=best_subset_f1,
+                                         epoch=epoch,
+                                         batch=batch,
+                                         device=device)
+        if scores['subset'] is not None and (best_subset_f1 is None or scores['subset'][1] > best_subset_f1):
+            best_subset_f1 = scores['subset'][1]
+
+        result_queue.put((epoch, batch, weight_path, scores))
+
+
+class AsyncValidator:
+    """
+    validate on a spawned process while training goes on. The trainer writes a snapshot of weights to a file
+    and sends it with `submit`, and gets the scores back with `collect` on the submitted order.
+    Snapshot files are reused by turns, so results should be applied before submitting the next ones.
+    Args:
+        - global_config:
+        - best_subset_f1: best f1 on dev subset before, such as from the resumed checkpoint
+        - max_pending: max count of validations sent and not collected
+    """
+
+    def __init__(self, global_config, best_subset_f1, max_pending=2):
+        self.max_pending = max_pending
+        self.weight_path = global_config['data']['model_path'] + '.valid%d'
+        self.submitted = 0
+        self.pending = 0
+
+        ctx = mp.get_context('spawn')
+        self.request_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=valid_process,
+                                   args=(global_config, best_subset_f1, self.request_queue, self.result_queue),
+                                   name='async-valid',
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, model, epoch, batch):
+        """
+        write weights of model to a snapshot file, and send it to validate
+        :param model:
+        :param epoch:
+        :param batch: next batch index in the epoch
+        :return:
+        """
+        if self.pending >= self.max_pending:
+            raise RuntimeError('%d validations pending, collect them before submit' % self.pending)
+
+        weight_path = self.weight_path % (self.submitted % self.max_pending)
+        save_checkpoint(model_state_without_embedding(model), weight_path)
+        self.request_queue.put((epoch, batch, weight_path))
+        self.submitted += 1
+        self.pending += 1
+
+    def collect(self, wait_pending=None):
+        """
+        results of the finished validations
+        :param wait_pending: wait until no more than it validations pending, or None not to wait
+        :return: list of (epoch, batch, weight_path, scores) on the submitted order
+        """
+        results = []
+        while self.pending > 0:
+            wait = wait_pending is not None and self.pending > wait_pending
+            try:
+                results.append(self.result_queue.get(block=wait, timeout=1 if wait else None))
+                self.pending -= 1
+            except queue.Empty:
+                if not wait:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError('validation process exited with code %s' % self.process.exitcode)
+        return results
+
+    def close(self):
+        """
+        stop the process, and remove the snapshot files. the pending validations are dropped,
+        such as when training is broken
+        :return:
+        """
+        if self.pending > 0:
+            self.process.terminate()
+        elif self.process.is_alive():
+            self.request_queue.put(None)
+        self.process.join()
+
+        for i in range(self.max_pending):
+            if os.path.exists(self.weight_path % i):
+                os.remove(self.weight_path % i)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import copy
+import random
+import logging
+import threading
+import torch
+import numpy as np
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def get_rng_state():
+    """
+    random states of python, numpy and torch, that dropout could be continued after resume
+    :return:
+    """
+    rng_state = {'python': random.getstate(),
+                 'numpy': np.random.get_state(),
+                 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    """
+    restore random states from `get_rng_state`
+    :param rng_state:
+    :return:
+    """
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'])
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+def model_state_without_embedding(model):
+    """
+    model weight without the fixed word embedding, which is loaded from hdf5 file
+    :param model:
+    :return:
+    """
+    model_weight = model.state_dict()
+    del model_weight['embedding.embedding_layer.weight']
+    return model_weight
+
+
+def save_checkpoint(state, checkpoint_path):
+    """
+    write checkpoint to a temp file and then rename it, so that a crash when writing never breaks the last one
+    :param state: dict of checkpoint
+    :param checkpoint_path:
+    :return:
+    """
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    load checkpoint on cpu if exist, the weights are moved to device of model and optimizer when loading state
+    :param checkpoint_path:
+    :return: dict of checkpoint, or None
+    """
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return None
+
+    # rng states are not plain tensors
+    return torch.load(checkpoint_path, map_location=lambda storage, loc: storage, weights_only=False)
+
+
+def snapshot_state(state):
+    """
+    copy all tensors in a nested state to cpu, that the copy not changed by the following training steps
+    :param state: tensor, or dict, list and tuple of them
+    :return:
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return state.__class__((k, snapshot_state(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return state.__class__(snapshot_state(v) for v in state)
+    return copy.deepcopy(state)
+
+
+class AsyncCheckpointWriter:
+    """
+    write checkpoints with `save_checkpoint` on a background thread. Only a snapshot copy is made on the caller,
+    and pending checkpoints of the same path are replaced by the newer one, so the caller never waits for disk
+    unless more than max_pending different paths are pending.
+    Args:
+        - max_pending: max count of checkpoints waiting to write
+    """
+
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.writing = False
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self.__run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state, checkpoint_path):
+        """
+        snapshot state and queue it to write
+        :param state:
+        :param checkpoint_path:
+        :return:
+        """
+        state = snapshot_state(state)
+        with self.cond:
+            self.__check_error()
+            while checkpoint_path not in self.pending and len(self.pending) >= self.max_pending:
+                self.cond.wait()
+                self.__check_error()
+            if checkpoint_path in self.pending:
+                logger.warning('checkpoint %s not written yet, replaced by the newer one' % checkpoint_path)
+            self.pending[checkpoint_path] = state
+            self.cond.notify_all()
+
+    def flush(self):
+        """
+        wait until all pending checkpoints written
+        :return:
+        """
+        with self.cond:
+            while self.pending or self.writing:
+                self.cond.wait()
+            self.__check_error()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def __check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                checkpoint_path, state = self.pending.popitem(last=False)
+                self.writing = True
+
+            try:
+                save_checkpoint(state, checkpoint_path)
+            except Exception as e:
+                logger.error('failed to write checkpoint %s: %s' % (checkpoint_path, e))
+                self.error = e
+            finally:
+                with self.cond:
+                    self.writing = False
+                    self.cond.notify_all()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(rank, world_size, port):
+    """
+    join the local process group with gloo backend, that works on cpu
+    :param rank:
+    :param world_size:
+    :param port: tcp port on localhost of rank 0
+    :return:
+    """
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group(backend='gloo', rank=rank, world_size=world_size)
+
+
+def broadcast_parameters(model, src=0):
+    """
+    make every process start with the same trainable weights of src, the fixed embedding is loaded from file
+    :param model:
+    :param src:
+    :return:
+    """
+    tensors = [p.data for p in model.parameters() if p.requires_grad]
+    buffer = _flatten_dense_tensors(tensors)
+    dist.broadcast(buffer, src)
+    for t, synced in zip(tensors, _unflatten_dense_tensors(buffer, tensors)):
+        t.copy_(synced)
+
+
+def all_reduce_gradients(model, world_size):
+    """
+    average gradients of all the processes in one all-reduce call on a flat buffer.
+    parameter without gradient in this step is treated as zeros, that all processes reduce the same size
+    :param model:
+    :param world_size:
+    :return:
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    grads = [p.grad.data for p in params]
+    buffer = _flatten_dense_tensors(grads)
+    dist.all_reduce(buffer)
+    buffer.div_(world_size)
+    for g, synced in zip(grads, _unflatten_dense_tensors(buffer, grads)):
+        g.copy_(synced)
+
+
+def all_reduce_sum(value):
+    """
+    sum a python number on all the processes
+    :param value:
+    :return:
+    """
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+
+def broadcast_flag(flag, src=0):
+    """
+    make every process get the bool flag of src
+    :param flag:
+    :param src:
+    :return:
+    """
+    tensor = torch.tensor([1 if flag else 0], dtype=torch.uint8)
+    dist.broadcast(tensor, src)
+    return bool(tensor.item())
+
+
+def all_gather_object(obj, world_size):
+    """
+    gather a picklable object from every process
+    :param obj:
+    :param world_size:
+    :return: list of objects on rank order
+    """
+    objs = [None] * world_size
+    dist.all_gather_object(objs, obj)
+    return objs
@@ -10,19 +10,21 @@ from dataset.preprocess_data import PreprocessData
 logger = logging.getLogger(__name__)
 
 
-def eval_on_model(model, criterion, batch_data, epoch, device, enable_char, batch_char_func):
+def eval_on_model(model, criterion, batch_data, epoch, device, enable_char, batch_char_func, batch_cnt=None):
     """
     evaluate on a specific trained model
     :param enable_char:
     :param batch_char_func: transform word id to char id representation
     :param model: model with weight loaded
     :param criterion:
-    :param batch_data: test data with batches
+    :param batch_data: test data with batches, could be an iterator that generates batch when evaluating
     :param epoch:
     :param device:
+    :param batch_cnt: count of batches for logging, required when batch_data is an iterator
     :return: (em, f1, sum_loss)
     """
-    batch_cnt = len(batch_data)
+    if batch_cnt is None:
+        batch_cnt = len(batch_data)
     dev_data_size = 0
     num_em = 0
     score_f1 = 0.
@@ -39,17 +41,16 @@ def eval_on_model(model, criterion, batch_data, epoch, device, enable_char, batc
         tmp_size = bat_answer_range.shape[0]
         dev_data_size += tmp_size
 
-        # get loss
-        batch_loss = criterion.forward(tmp_ans_prop, bat_answer_range[:, 0:2])
+        # get loss, on the first answer or all the padded answers with `multi_span` criterion
+        batch_loss = criterion.forward(tmp_ans_prop, bat_answer_range)
         sum_loss += batch_loss.item() * tmp_size
 
-        # calculate the mean em and f1 score
-        for i in range(tmp_size):
-            if evaluate_em(tmp_ans_range[i].cpu().numpy(), bat_answer_range[i].cpu().numpy()):
-                num_em += 1
-            score_f1 += evaluate_f1(bat_context[i].cpu().numpy(),
-                                    tmp_ans_range[i].cpu().numpy(),
-                                    bat_answer_range[i].cpu().numpy())
+        # calculate the mean em and f1 score, scores of the batch moved to cpu together
+        batch_em, batch_f1 = evaluate_batch(bat_context, tmp_ans_range, bat_answer_range)
+        batch_em, batch_f1 = torch.stack((batch_em.double(), batch_f1)).tolist()
+        num_em += int(sum(batch_em))
+        for f1 in batch_f1:
+            score_f1 += f1
         if epoch is None:
             logger.info('test: batch=%d/%d, cur_score_em=%.2f, cur_score_f1=%.2f, batch_loss=%.5f' %
                         (bnum, batch_cnt, num_em * 1. / dev_data_size, score_f1 / dev_data_size, batch_loss))
@@ -69,6 +70,57 @@ def eval_on_model(model, criterion, batch_data, epoch, device, enable_char, batc
     return score_em, score_f1, sum_loss
 
 
+def eval_valid_on_model(model, criterion, dataset, batch_subset_data, global_config, best_subset_f1, epoch, batch,
+                        device):
+    """
+    evaluate on the fixed dev subset, and on the whole dev set only when the subset f1 improved
+    :param model: model on eval mode
+    :param criterion:
+    :param dataset:
+    :param batch_subset_data: batches of dev subset, or None to always evaluate on the whole dev set
+    :param global_config:
+    :param best_subset_f1: best f1 on the dev subset before, or None
+    :param epoch:
+    :param batch: next batch index in the epoch, for logging
+    :param device:
+    :return: dict of 'subset' and 'valid' scores, each (em, f1, sum_loss, size) or None when not evaluated
+    """
+    valid_batch_size = global_config['train']['valid_batch_size']
+    enable_char = global_config['model']['encoder']['enable_char']
+    scores = {'subset': None, 'valid': None}
+
+    if batch_subset_data is not None:
+        subset_em, subset_f1, subset_loss = eval_on_model(model=model,
+                                                          criterion=criterion,
+                                                          batch_data=batch_subset_data,
+                                                          epoch=epoch,
+                                                          device=device,
+                                                          enable_char=enable_char,
+                                                          batch_char_func=dataset.gen_batch_with_char)
+        subset_size = sum(map(lambda x: x[0].shape[0], batch_subset_data))
+        logger.info("epoch=%d, batch=%d, subset_score_em=%.2f, subset_score_f1=%.2f, sum_loss=%.5f" %
+                    (epoch, batch, subset_em, subset_f1, subset_loss))
+        scores['subset'] = (subset_em, subset_f1, subset_loss, subset_size)
+
+        if best_subset_f1 is not None and subset_f1 <= best_subset_f1:
+            return scores
+
+    valid_score_em, valid_score_f1, valid_loss = \
+        eval_on_model(model=model,
+                      criterion=criterion,
+                      batch_data=dataset.get_batch_dev(valid_batch_size),
+                      epoch=epoch,
+                      device=device,
+                      enable_char=enable_char,
+                      batch_char_func=dataset.gen_batch_with_char,
+                      batch_cnt=dataset.get_dev_batch_cnt(valid_batch_size))
+    logger.info("epoch=%d, ave_score_em=%.2f, ave_score_f1=%.2f, sum_loss=%.5f" %
+                (epoch, valid_score_em, valid_score_f1, valid_loss))
+    scores['valid'] = (valid_score_em, valid_score_f1, valid_loss, dataset.get_dev_size())
+
+    return scores
+
+
 # ---------------------------------------------------------------------------------
 # Here is the two evaluate function modified from standard file 'evaluate-v1.1.py'.
 # We just use it to show how model effect during training or evaluating.
@@ -76,6 +128,54 @@ def eval_on_model(model, criterion, batch_data, epoch, device, enable_char, batc
 # and then use 'evaluate-v1.1.py' to evaluate
 # ---------------------------------------------------------------------------------
 
+def evaluate_batch(context, y_pred, y_true):
+    """
+    exact match and bag of tokens F1 score on a batch of tensors, the same as `evaluate_em` and `evaluate_f1`
+    on every sample. distinct tokens of each answer are found on the sorted token ids of the answer,
+    which are gathered in the width of the longest answer instead of the whole context
+    :param context: (batch, context_len) context with word ids
+    :param y_pred: (batch, answer_len)
+    :param y_true: (batch, condidate_answer_len)
+    :return: em (batch,) bool, f1 (batch,) float64
+    """
+    batch_size, context_len = context.shape
+    y_pred = y_pred.long()
+    y_true = y_true.long().view(batch_size, -1, 2)  # (batch, candidate_num, 2)
+
+    em = y_true.eq(y_pred.unsqueeze(1)).all(2).any(1)
+
+    # token ids in each answer and -1 out of it: (batch, 1 + candidate_num, answer_width)
+    ranges = torch.cat((y_pred.unsqueeze(1), y_true), dim=1)
+    answer_width = max(int((ranges[:, :, 1].clamp(max=context_len - 1) - ranges[:, :, 0]).max()) + 1, 1)
+    positions = ranges[:, :, 0:1] + torch.arange(answer_width, device=context.device).view(1, 1, -1)
+    in_answer = positions.ge(0) & positions.le(ranges[:, :, 1:2]) & positions.lt(context_len)
+    tokens = context.long().unsqueeze(1).expand(-1, ranges.shape[1], -1).gather(2, positions.clamp(0, context_len - 1))
+    tokens = tokens.masked_fill(~in_answer, -1)
+
+    # distinct tokens, the first of equal ones after sorting
+    tokens = tokens.sort(2)[0]
+    distinct = torch.cat((tokens[:, :, :1].ge(0), tokens[:, :, 1:].ne(tokens[:, :, :-1])), dim=2) & tokens.ge(0)
+    distinct_num = distinct.sum(2).double()
+    tokens = tokens.masked_fill(~distinct, -1)
+
+    # same tokens appear twice in the sorted distinct tokens of prediction and each candidate
+    pred_tokens = tokens[:, 0:1].expand(-1, y_true.shape[1], -1)
+    pair_tokens = torch.cat((pred_tokens, tokens[:, 1:]), dim=2).sort(2)[0]
+    same_num = (pair_tokens[:, :, 1:].eq(pair_tokens[:, :, :-1]) & pair_tokens[:, :, 1:].ge(0)).sum(2).double()
+
+    pred_num = distinct_num[:, 0:1]
+    true_num = distinct_num[:, 1:]
+    precision = same_num / pred_num.clamp(min=1)
+    recall = same_num / true_num.clamp(min=1)
+    f1 = torch.where(precision + recall > 0, 2 * precision * recall / (precision + recall), torch.zeros_like(precision))
+
+    # best of the candidates without padding, and zero of empty prediction
+    f1 = f1.masked_fill(y_true[:, :, 0].eq(PreprocessData.answer_padding_idx), float('-inf')).max(1)[0]
+    f1 = f1.masked_fill(pred_num[:, 0].eq(0), 0.)
+
+    return em, f1
+
+
 def evaluate_em(y_pred, y_true):
     """
     exact match score
@@ -4,6 +4,7 @@
 __author__ = 'han'
 
 import torch
+import torch.nn.functional as F
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
@@ -126,12 +127,13 @@ def generate_mask(batch_length):
 
 def masked_softmax(x, m=None, dim=-1):
     """
-    Softmax with mask
+    Softmax with mask, always computed on float32 even when low precision input
     :param x:
     :param m:
     :param dim:
     :return:
     """
+    x = x.float()
     if m is not None:
         m = m.float()
         x = x * m
@@ -142,6 +144,21 @@ def masked_softmax(x, m=None, dim=-1):
     return softmax
 
 
+def masked_log_softmax(x, m=None, dim=-1):
+    """
+    Log softmax with mask, masked values get a large negative score instead of zero probability.
+    always computed on float32 even when low precision input
+    :param x:
+    :param m:
+    :param dim:
+    :return:
+    """
+    x = x.float()
+    if m is not None:
+        x = x.masked_fill(m.eq(0), -1e30)
+    return F.log_softmax(x, dim=dim)
+
+
 def draw_heatmap(x, xlabels, ylabels, x_top=False):
     """
     draw matrix heatmap with matplotlib
@@ -211,48 +228,68 @@ def draw_heatmap_sea(x, xlabels, ylabels, answer, save_path, inches=(11, 3), bot
     fig.savefig(save_path)
 
 
-def answer_search(answer_prop, mask, max_tokens=15):
+def answer_search(answer_prop, mask, max_tokens=15, top_k=None, log_space=False):
     """
-    global search best answer for model predict
+    global search best answer for model predict, only the start x end probability on a band
+    that answer no more than max_tokens and not over each context length are considered
     :param answer_prop: (batch, answer_len, context_len)
-    :return:
+    :param mask: (batch, context_len)
+    :param max_tokens: max tokens of answer
+    :param top_k: If not None, return the best k answers with their score
+    :param log_space: If True, answer_prop is log-probability and the start and end scores are summed
+    :return: ans_range (batch, 2), or (ans_range (batch, k, 2), ans_score (batch, k)) when top_k
     """
     batch_size = answer_prop.shape[0]
     context_len = answer_prop.shape[2]
-
-    # get min length
-    lengths = mask.data.eq(1).long().sum(1).squeeze()
-    min_length, _ = torch.min(lengths, 0)
-    min_length = min_length.item()
-
-    # max move steps
-    max_move = max_tokens + context_len - min_length
-    max_move = min(context_len, max_move)
+    max_move = min(max_tokens, context_len)
 
     ans_s_p = answer_prop[:, 0, :]
     ans_e_p = answer_prop[:, 1, :]
-    b_zero = answer_prop.new_zeros(batch_size, 1)
 
-    # each step, move ans-start-prop matrix to right with one element
-    ans_s_e_p_lst = []
-    for i in range(max_move):
-        tmp_ans_s_e_p = ans_s_p * ans_e_p
-        ans_s_e_p_lst.append(tmp_ans_s_e_p)
+    # band of end probability, where ans_e_band[:, s, i] = ans_e_p[:, s + i]: (batch, context_len, max_move)
+    ans_e_band = F.pad(ans_e_p, (0, max_move - 1)).unfold(1, max_move, 1)
+    if log_space:
+        ans_s_e_p = ans_s_p.unsqueeze(2) + ans_e_band
+    else:
+        ans_s_e_p = ans_s_p.unsqueeze(2) * ans_e_band
+
+    # answer end should be in each context length
+    lengths = mask.eq(1).long().sum(1)
+    ans_e_pos = torch.arange(context_len, device=answer_prop.device).unsqueeze(1) + \
+        torch.arange(max_move, device=answer_prop.device).unsqueeze(0)  # (context_len, max_move)
+    ans_valid = ans_e_pos.unsqueeze(0) < lengths.view(-1, 1, 1)
+    ans_s_e_p = ans_s_e_p.masked_fill(~ans_valid, float('-inf')).view(batch_size, -1)
+
+    if top_k is None:
+        _, ans_idx = torch.max(ans_s_e_p, 1)
+    else:
+        ans_score, ans_idx = torch.topk(ans_s_e_p, min(top_k, ans_s_e_p.shape[1]), dim=1)
+
+    # get the start position and move steps
+    ans_s = torch.div(ans_idx, max_move, rounding_mode='floor')
+    ans_e = ans_s + ans_idx % max_move
 
-        ans_s_p = ans_s_p[:, :(context_len - 1)]
-        ans_s_p = torch.cat((b_zero, ans_s_p), dim=1)
-    ans_s_e_p = torch.stack(ans_s_e_p_lst, dim=2)
+    ans_range = torch.stack((ans_s, ans_e), dim=-1)
+    if top_k is None:
+        return ans_range
+    return ans_range, ans_score
 
-    # get the best end position, and move steps
-    max_prop1, max_prop_idx1 = torch.max(ans_s_e_p, 1)
-    max_prop2, max_prop_idx2 = torch.max(max_prop1, 1)
 
-    ans_e = max_prop_idx1.gather(1, max_prop_idx2.unsqueeze(1)).squeeze(1)
-    # ans_e = max_prop_idx1[:, max_prop_idx2].diag()  # notice that only diag element valid, the same with top ways
-    ans_s = ans_e - max_prop_idx2
+def window_starts(length, window_size, window_stride):
+    """
+    start positions of overlapping windows that cover a sequence, the last window is moved back to end
+    at the sequence end, that every window is full when the sequence is longer than window_size
+    :param length: sequence length
+    :param window_size:
+    :param window_stride:
+    :return: list of start positions, [0] when no longer than window_size
+    """
+    if length <= window_size:
+        return [0]
 
-    ans_range = torch.stack((ans_s, ans_e), dim=1)
-    return ans_range
+    starts = list(range(0, length - window_size, window_stride))
+    starts.append(length - window_size)
+    return starts
 
 
 def flip(tensor, flip_dim=0):
@@ -289,6 +326,28 @@ def del_zeros_right(tensor):
     return tensor
 
 
+def split_micro_batches(batch_data, max_tokens):
+    """
+    split a batch to micro-batches on batch dim, that each has no more than max_tokens context tokens,
+    the extra zeros on right of context and question are deleted again for every micro-batch
+    :param batch_data: [bat_context, bat_question, bat_answer_range]
+    :param max_tokens: max of batch_size * context_len, no split when not greater than zero
+    :return: list of micro-batches
+    """
+    bat_context, bat_question, bat_answer_range = batch_data
+    batch_size, context_len = bat_context.shape
+    if max_tokens <= 0 or batch_size * context_len <= max_tokens:
+        return [batch_data]
+
+    micro_size = max(1, max_tokens // context_len)
+    micro_batches = []
+    for i in range(0, batch_size, micro_size):
+        micro_batches.append([del_zeros_right(bat_context[i:i + micro_size]),
+                              del_zeros_right(bat_question[i:i + micro_size]),
+                              bat_answer_range[i:i + micro_size]])
+    return micro_batches
+
+
 def masked_flip(vin, mask, flip_dim=0):
     """
     flip a tensor
@@ -329,3 +388,62 @@ def pop_dict_keys(d, ks_sub):
                 break
 
     return d
+
+
+def set_torch_threads(num_threads, num_interop_threads):
+    """
+    set intra-op and inter-op threads of torch, the inter-op one must be set before any parallel work starts
+    :param num_threads: 0 to keep torch default
+    :param num_interop_threads: 0 to keep torch default
+    :return:
+    """
+    if num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def quantize_dynamic_model(model):
+    """
+    dynamic int8 quantization on linear and rnn layers, weights are quantized ahead
+    and activations are quantized on the fly. Note that only used for cpu inference
+    :param model:
+    :return: quantized model, modified inplace
+    """
+    quantize_modules = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU, torch.nn.LSTMCell, torch.nn.GRUCell}
+    return torch.quantization.quantize_dynamic(model, quantize_modules, dtype=torch.qint8, inplace=True)
+
+
+def quantize_rowwise(x):
+    """
+    8-bit symmetric quantization with a scale on each row
+    :param x: (rows, dim) float numpy array
+    :return: (int8 array, float32 scale with shape (rows,))
+    """
+    scale = np.abs(x).max(axis=1) / 127.
+    scale[scale == 0] = 1.
+    x_q = np.round(x / scale[:, None]).astype(np.int8)
+    return x_q, scale.astype(np.float32)
+
+
+def convert_embedding_storage(vec, scale, storage):
+    """
+    convert embedding matrix to the storage type
+    :param vec: (n, dim) numpy array of float32, float16, or int8 with row-wise scale
+    :param scale: (n,) row-wise scale when vec is int8, else None
+    :param storage: 'float32', 'float16' or 'int8'
+    :return: (vec, scale), where scale is None when not int8 storage
+    """
+    if vec.dtype == np.int8:
+        if storage == 'int8':
+            return vec, scale.astype(np.float32, copy=False)
+        vec = vec.astype(np.float32) * scale[:, None]
+
+    if storage == 'float32':
+        return vec.astype(np.float32, copy=False), None
+    elif storage == 'float16':
+        return vec.astype(np.float16, copy=False), None
+    elif storage == 'int8':
+        return quantize_rowwise(vec.astype(np.float32, copy=False))
+    else:
+        raise ValueError('Unrecognized embedding storage %s, change to float32, float16 or int8' % storage)
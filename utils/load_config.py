@@ -16,24 +16,44 @@ def init_logging(config_path='config/logging_config.yaml'):
     """
     try:
         with open(config_path, 'r') as f:
-            config = yaml.load(f.read())
+            config = yaml.safe_load(f.read())
         logging.config.dictConfig(config)
     except IOError:
         sys.stderr.write('logging config file "%s" not found' % config_path)
         logging.basicConfig(level=logging.DEBUG)
 
 
-def read_config(config_path='config/model_config.yaml'):
+def read_config(config_path='config/model_config.yaml', overlay_paths=None):
     """
     store the global parameters in the project
     :param config_path:
+    :param overlay_paths: config files with part of the keys, that override values of config_path in order
     :return:
     """
     try:
         with open(config_path, 'r') as f:
-            config = yaml.load(f.read())
+            config = yaml.safe_load(f.read())
+
+        for overlay_path in overlay_paths or []:
+            with open(overlay_path, 'r') as f:
+                merge_config(config, yaml.safe_load(f.read()))
         return config
 
-    except IOError:
-        sys.stderr.write('logging config file "%s" not found' % config_path)
+    except IOError as e:
+        sys.stderr.write('config file "%s" not found' % e.filename)
         exit(-1)
+
+
+def merge_config(config, overlay):
+    """
+    override values of config with overlay recursively, the keys not in overlay are kept
+    :param config:
+    :param overlay:
+    :return:
+    """
+    for key, value in (overlay or {}).items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            merge_config(config[key], value)
+        else:
+            config[key] = value
+    return config
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'han'
+
+import os
+import json
+import time
+import torch
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+
+class MetricsWriter:
+    """
+    write training metrics as one json record per line, appended to the file so that a resumed training
+    continues the same stream. Every record has a `type` and wall clock `timestamp`
+    Args:
+        - metrics_path: path of jsonl file
+    """
+
+    def __init__(self, metrics_path):
+        metrics_dir = os.path.dirname(metrics_path)
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+        self.f = open(metrics_path, 'a')
+
+    def write(self, record_type, **kwargs):
+        record = OrderedDict(type=record_type, timestamp=time.time())
+        record.update(kwargs)
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class StepTimer:
+    """
+    split time of one step into phases, each `lap` adds the time from the last lap to the phase
+    """
+
+    def __init__(self):
+        self.times = OrderedDict()
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.) + now - self.last
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+
+def peak_memory_mb(device):
+    """
+    peak memory of the process, allocated tensors on cuda or max resident set size on cpu
+    :param device:
+    :return: MB, or None when not supported
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 1024. / 1024.
+    if resource is None:
+        return None
+
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.